@@ -9,5 +9,6 @@ sys.path.append(os.path.normpath(PATH))
 if 1:
     import nextpress
 
-nextpress.main()
+if __name__ == '__main__':
+    sys.exit(nextpress.main())
 
@@ -914,8 +914,11 @@ class WebKit (object):
         return True
 
     def text2html (self, s):
-        import cgi
-        return cgi.escape(s, True).replace('\n', "</br>\n")
+        try:
+            from html import escape
+        except ImportError:
+            from cgi import escape
+        return escape(s, True).replace('\n', "</br>\n")
 
     def html2text (self, html):
         part = []
@@ -0,0 +1,556 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#======================================================================
+#
+# benchmark.py - markdown conversion benchmark
+#
+#======================================================================
+from __future__ import print_function, unicode_literals
+import sys
+import os
+import time
+import random
+import json
+import ascmini
+import config
+import profiler
+import utils
+
+
+#----------------------------------------------------------------------
+# 2/3 compatible
+#----------------------------------------------------------------------
+if sys.version_info[0] >= 3:
+    unicode = str
+    xrange = range
+
+
+#----------------------------------------------------------------------
+# corpus features and their default weights
+#----------------------------------------------------------------------
+FEATURES = {
+    'prose': 4,
+    'links': 2,
+    'code': 2,
+    'table': 1,
+    'footnote': 1,
+    'list': 2,
+    'html': 1,
+    'viz': 1,
+}
+
+ENGINES = ['native', 'markdown', 'pandoc']
+
+WORDS = '''lorem ipsum dolor sit amet consectetur adipiscing elit sed do
+eiusmod tempor incididunt ut labore et dolore magna aliqua enim ad minim
+veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea
+commodo consequat duis aute irure in reprehenderit voluptate velit esse
+cillum fugiat nulla pariatur excepteur sint occaecat cupidatat non
+proident sunt culpa qui officia deserunt mollit anim id est laborum
+socket buffer kernel thread queue latency packet python server'''.split()
+
+
+#----------------------------------------------------------------------
+# CorpusGenerator: deterministic synthetic markdown documents
+#----------------------------------------------------------------------
+class CorpusGenerator (object):
+
+    def __init__ (self, seed = 0, mix = None):
+        self._random = random.Random(seed)
+        self._mix = dict(FEATURES)
+        if mix:
+            self._mix.update(mix)
+        self._names = [ n for n in sorted(self._mix) if self._mix[n] > 0 ]
+        self._weights = [ self._mix[n] for n in self._names ]
+        self._counter = 0
+
+    def __words (self, count):
+        rand = self._random
+        return ' '.join([ rand.choice(WORDS) for i in xrange(count) ])
+
+    def __sentence (self):
+        rand = self._random
+        text = self.__words(rand.randint(6, 16))
+        text = text[:1].upper() + text[1:]
+        if rand.random() < 0.2:
+            text += ' with *emphasis* and `inline code`'
+        return text + '.'
+
+    def _prose (self):
+        count = self._random.randint(2, 6)
+        return ' '.join([ self.__sentence() for i in xrange(count) ])
+
+    def _links (self):
+        rand = self._random
+        parts = []
+        for i in xrange(rand.randint(3, 8)):
+            self._counter += 1
+            word = self.__words(rand.randint(1, 3))
+            if rand.random() < 0.5:
+                url = 'https://example.com/%s/%d'%(rand.choice(WORDS), i)
+                parts.append('%s [%s](%s)'%(self.__words(4), word, url))
+            else:
+                parts.append('%s [%s][ref%d]'%(self.__words(4), word,
+                    self._counter))
+                parts.append('\n\n[ref%d]: https://example.org/%d\n\n'%(
+                    self._counter, self._counter))
+        return ' '.join(parts)
+
+    def _code (self):
+        rand = self._random
+        lang = rand.choice(['python', 'cpp', 'text', 'bash', ''])
+        lines = []
+        for i in xrange(rand.randint(3, 20)):
+            indent = '    ' * rand.randint(0, 2)
+            lines.append(indent + '%s = %s("%s") < %d && `x`'%(
+                rand.choice(WORDS), rand.choice(WORDS),
+                self.__words(2), i))
+        fence = rand.choice(['```', '~~~'])
+        return fence + lang + '\n' + '\n'.join(lines) + '\n' + fence
+
+    def _table (self):
+        rand = self._random
+        cols = rand.randint(2, 5)
+        rows = ['| ' + ' | '.join([ 'head%d'%i for i in xrange(cols) ]) + ' |']
+        rows.append('|' + '|'.join([ '---' for i in xrange(cols) ]) + '|')
+        for y in xrange(rand.randint(2, 10)):
+            cells = [ self.__words(rand.randint(1, 3)) for i in xrange(cols) ]
+            rows.append('| ' + ' | '.join(cells) + ' |')
+        return '\n'.join(rows)
+
+    def _footnote (self):
+        self._counter += 1
+        name = 'fn%d'%self._counter
+        text = self.__sentence() + '[^%s]'%name
+        return text + '\n\n[^%s]: %s'%(name, self.__sentence())
+
+    def _list (self, depth = 0):
+        rand = self._random
+        lines = []
+        ordered = rand.random() < 0.3
+        for i in xrange(rand.randint(2, 6)):
+            mark = ordered and ('%d.'%(i + 1)) or rand.choice('-*+')
+            lines.append('    ' * depth + mark + ' ' + self.__words(6))
+            if depth < 2 and rand.random() < 0.25:
+                lines.append('')
+                lines.append(self._list(depth + 1))
+                lines.append('')
+        return '\n'.join(lines)
+
+    def _html (self):
+        rand = self._random
+        tag = rand.choice(['div', 'table', 'blockquote'])
+        if tag == 'table':
+            return '<table>\n<tr><td>%s</td></tr>\n</table>'%self.__words(3)
+        return '<%s class="box">\n%s\n</%s>'%(tag, self.__words(12), tag)
+
+    def _viz (self):
+        rand = self._random
+        edges = []
+        for i in xrange(rand.randint(2, 12)):
+            edges.append('    %s -> %s'%(rand.choice(WORDS),
+                rand.choice(WORDS)))
+        engine = rand.choice(['dot', 'circo', 'neato'])
+        return '```viz-%s\ndigraph G {\n%s\n}\n```'%(engine, '\n'.join(edges))
+
+    def block (self):
+        rand = self._random
+        name = rand.choices(self._names, self._weights)[0]
+        return getattr(self, '_' + name)()
+
+    # generate a document with approximate size in bytes
+    def document (self, size, uuid = 1):
+        blocks = ['---', 'uuid: %d'%uuid, 'title: benchmark %d'%uuid,
+            'status: draft', '---', '']
+        total = 0
+        while total < size:
+            if self._random.random() < 0.08:
+                level = self._random.randint(1, 3)
+                text = '#' * level + ' ' + self.__words(4)
+            else:
+                text = self.block()
+            blocks.append(text)
+            blocks.append('')
+            total += len(text) + 1
+        return '\n'.join(blocks)
+
+
+#----------------------------------------------------------------------
+# parse mix option: "code:3,table:0"
+#----------------------------------------------------------------------
+def parse_mix(text):
+    mix = {}
+    for name, value in ascmini.compact_loads(text or '').items():
+        if name not in FEATURES:
+            raise ValueError('unknown feature: ' + name)
+        mix[name] = float(value)
+    return mix
+
+
+#----------------------------------------------------------------------
+# write corpus into a directory
+#----------------------------------------------------------------------
+def corpus_save(path, docs, size, seed = 0, mix = None):
+    gen = CorpusGenerator(seed, mix)
+    if not os.path.exists(path):
+        ascmini.posix.mkdir(path)
+    names = []
+    for i in xrange(docs):
+        name = os.path.join(path, 'bench%04d.md'%(i + 1))
+        ascmini.posix.save_file_text(name, gen.document(size, i + 1))
+        names.append(name)
+    return names
+
+
+#----------------------------------------------------------------------
+# percentile of sorted list
+#----------------------------------------------------------------------
+def percentile(values, ratio):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = int(round((len(values) - 1) * ratio))
+    return values[index]
+
+
+#----------------------------------------------------------------------
+# check engine availability
+#----------------------------------------------------------------------
+def engine_available(engine):
+    if engine == 'markdown':
+        import importlib.util
+        return importlib.util.find_spec('markdown') is not None
+    elif engine == 'pandoc':
+        return ascmini.posix.search_cmd('pandoc') is not None
+    return True
+
+
+#----------------------------------------------------------------------
+# convert and render every document once, viz and cmd blocks included,
+# returns (latencies, bytes)
+#----------------------------------------------------------------------
+def _convert_all(engine, names):
+    import render
+    latency = []
+    total = 0
+    for name in names:
+        t1 = profiler.clock()
+        doc = utils.MarkdownDoc(name)
+        html = doc.convert(engine)
+        hr = render.HtmlRender(html)
+        hr.process_viz()
+        hr.render()
+        latency.append(profiler.clock() - t1)
+        total += len(doc._content.encode('utf-8'))
+    return latency, total
+
+
+#----------------------------------------------------------------------
+# measure one engine over the corpus, peak memory is traced in an
+# extra pass to keep tracemalloc overhead out of the timings
+#----------------------------------------------------------------------
+def measure(engine, names, repeat = 1):
+    import tracemalloc
+    latency = []
+    total = 0
+    profiler.enable()
+    profiler.reset()
+    ts = profiler.clock()
+    for i in xrange(repeat):
+        lat, size = _convert_all(engine, names)
+        latency.extend(lat)
+        total += size
+    elapse = profiler.clock() - ts
+    data = profiler.snapshot(True)
+    profiler.enable(False)
+    tracemalloc.start()
+    _convert_all(engine, names)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stages = {}
+    for key, (calls, span, _, hi) in data['spans'].items():
+        stages[key] = {'calls': calls, 'total_ms': span / 1000000.0,
+            'mean_ms': span / 1000000.0 / calls}
+    result = {}
+    result['docs'] = len(latency)
+    result['bytes'] = total
+    result['elapse_ms'] = elapse / 1000000.0
+    result['throughput_mbs'] = total / 1048576.0 / max(elapse / 1e9, 1e-9)
+    result['docs_per_sec'] = len(latency) / max(elapse / 1e9, 1e-9)
+    result['p50_ms'] = percentile(latency, 0.50) / 1000000.0
+    result['p99_ms'] = percentile(latency, 0.99) / 1000000.0
+    result['peak_kb'] = peak / 1024.0
+    result['stages'] = stages
+    return result
+
+
+#----------------------------------------------------------------------
+# run benchmark, returns json compatible object
+#----------------------------------------------------------------------
+def run(docs = 20, size = 16384, seed = 0, mix = None, engines = None,
+        repeat = 3, path = None):
+    import tempfile
+    import platform
+    import markdown2
+    engines = engines or ENGINES
+    report = {}
+    report['python'] = platform.python_version()
+    report['markdown2'] = markdown2.__version__
+    report['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    report['corpus'] = {'docs': docs, 'size': size, 'seed': seed,
+            'mix': mix or {}}
+    report['engines'] = {}
+    # diagrams are rendered every time, not read from the disk cache
+    cache = config.options['cache']
+    config.options['cache'] = ''
+    try:
+        with tempfile.TemporaryDirectory(prefix = 'markpress.') as temp:
+            names = corpus_save(path or temp, docs, size, seed, mix)
+            for engine in engines:
+                if not engine_available(engine):
+                    report['engines'][engine] = None
+                    continue
+                # warm up: imports and lazy initializations
+                utils.MarkdownDoc(names[0]).convert(engine)
+                report['engines'][engine] = measure(engine, names, repeat)
+    finally:
+        config.options['cache'] = cache
+    return report
+
+
+#----------------------------------------------------------------------
+# scaling documents: count is the number of repeated constructs
+#----------------------------------------------------------------------
+def _scale_lists(count):
+    parts = []
+    for i in xrange(count):
+        parts.append('Paragraph %d before the list.'%i)
+        if i % 2:
+            items = [ '%d. item %d.%d'%(j + 1, i, j) for j in xrange(3) ]
+        else:
+            items = [ '- item %d.%d'%(i, j) for j in xrange(3) ]
+        parts.append('\n'.join(items))
+    return '\n\n'.join(parts) + '\n\n'
+
+
+def _scale_links(count):
+    parts = []
+    for i in xrange(count):
+        if i % 4 == 3:
+            parts.append('![image %d](https://example.com/%d.png "title")'%(i, i))
+        elif i % 4 == 2:
+            parts.append('[![badge](https://example.com/b%d.svg)](https://example.com/%d)'%(i, i))
+        else:
+            parts.append('see [link %d](https://example.com/page_%d) here'%(i, i))
+    return ' '.join(parts) + '\n'
+
+
+def _scale_fenced(count):
+    parts = []
+    for i in xrange(count):
+        fence = (i % 3 == 2) and '~~~' or '```'
+        if i % 5 == 4:
+            fence = '````'
+        parts.append('Paragraph %d before the code, with trailing spaces.  '%i)
+        parts.append('%s%s'%(fence, (i % 2) and 'python' or ''))
+        for j in xrange(8):
+            parts.append('\tif a[%d] < b and c > %d: # `%d` & more text'%(j, i, j))
+        if i % 5 == 4:
+            parts.append('```')
+            parts.append('shorter fence is content')
+            parts.append('```')
+        parts.append(fence)
+        parts.append('')
+    return '\n'.join(parts) + '\n'
+
+
+def _scale_tabs(count):
+    row = '\t'.join([ 'cell%d'%i for i in xrange(count) ])
+    return '\n'.join([ '\t' + row for i in xrange(10) ]) + '\n'
+
+
+# name -> (document maker, markdown2 method or function, largest count)
+SCALES = {
+    'lists': (_scale_lists, '_do_lists', 10000),
+    'links': (_scale_links, '_do_links', 10000),
+    'fenced': (_scale_fenced, utils.fenced_code_block, 24000),
+    'tabs': (_scale_tabs, '_detab', 10000),
+}
+
+
+#----------------------------------------------------------------------
+# time one stage on documents doubling in size, the time per construct
+# stays flat when the stage is linear
+#----------------------------------------------------------------------
+def scaling(name, steps = 4):
+    import markdown2
+    maker, method, count = SCALES[name]
+    md = markdown2.Markdown(extras = utils.MD_EXTRAS)
+    result = []
+    for i in xrange(steps):
+        n = count >> (steps - 1 - i)
+        text = maker(n)
+        md.reset()
+        stage = callable(method) and method or getattr(md, method)
+        t1 = profiler.clock()
+        stage(text)
+        elapse = profiler.clock() - t1
+        result.append({'count': n, 'bytes': len(text),
+            'ms': elapse / 1000000.0})
+    return result
+
+def scaling_table(name, result):
+    rows = [[name, 'KB', 'ms', 'us/item', 'ratio']]
+    base = result[0]['ms'] / max(result[0]['count'], 1)
+    for item in result:
+        unit = item['ms'] / max(item['count'], 1)
+        ratio = base and (unit / base) or 0.0
+        rows.append([item['count'], '%.1f'%(item['bytes'] / 1024.0),
+            '%.3f'%item['ms'], '%.3f'%(unit * 1000.0), '%.2f'%ratio])
+    return ascmini.tabulify(rows, 1)
+
+
+#----------------------------------------------------------------------
+# regression: compare html byte for byte with a reference markdown2.py,
+# eg. "git show HEAD~1:lib/markdown2.py > ref.py", returns mismatches
+#----------------------------------------------------------------------
+def verify(reference, docs = 20, size = 16384, seed = 0, mix = None):
+    import importlib.util
+    import markdown2
+    spec = importlib.util.spec_from_file_location('markdown2_ref', reference)
+    ref = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(ref)
+    gen = CorpusGenerator(seed, mix)
+    texts = []
+    for i in xrange(docs):
+        texts.append(('corpus%04d'%(i + 1), gen.document(size, i + 1)))
+    for name in sorted(SCALES):
+        texts.append(('scale.' + name, SCALES[name][0](200)))
+    rows = [['document', 'bytes', 'result']]
+    failed = 0
+    for name, text in texts:
+        html1 = ref.Markdown(extras = utils.MD_EXTRAS).convert(text)
+        html2 = markdown2.Markdown(extras = utils.MD_EXTRAS).convert(text)
+        if html1 == html2:
+            rows.append([name, len(text), 'ok'])
+            continue
+        pos = 0
+        while pos < min(len(html1), len(html2)) and html1[pos] == html2[pos]:
+            pos += 1
+        rows.append([name, len(text), 'differs at %d'%pos])
+        failed += 1
+    print(ascmini.tabulify(rows, 1))
+    return failed
+
+
+#----------------------------------------------------------------------
+# tables
+#----------------------------------------------------------------------
+def report_table(report):
+    rows = [['engine', 'docs', 'MB/s', 'docs/s', 'p50(ms)', 'p99(ms)',
+        'peak(KB)']]
+    for engine, result in sorted(report['engines'].items()):
+        if result is None:
+            rows.append([engine, 'n/a'])
+            continue
+        rows.append([engine, result['docs'],
+            '%.3f'%result['throughput_mbs'], '%.1f'%result['docs_per_sec'],
+            '%.3f'%result['p50_ms'], '%.3f'%result['p99_ms'],
+            '%.1f'%result['peak_kb']])
+    output = [ascmini.tabulify(rows, 1)]
+    rows = [['engine', 'stage', 'calls', 'total(ms)', 'mean(ms)']]
+    for engine, result in sorted(report['engines'].items()):
+        if result is None:
+            continue
+        for stage, item in sorted(result['stages'].items()):
+            rows.append([engine, stage, item['calls'],
+                '%.3f'%item['total_ms'], '%.3f'%item['mean_ms']])
+    output.append(ascmini.tabulify(rows, 1))
+    return '\n\n'.join(output)
+
+def compare_table(old, new):
+    rows = [['engine', 'metric', 'old', 'new', 'change']]
+    keys = ['throughput_mbs', 'p50_ms', 'p99_ms', 'peak_kb']
+    for engine in sorted(new['engines']):
+        r1 = old['engines'].get(engine)
+        r2 = new['engines'].get(engine)
+        if not r1 or not r2:
+            continue
+        for key in keys:
+            v1, v2 = r1[key], r2[key]
+            change = v1 and ('%+.1f%%'%((v2 - v1) * 100.0 / v1)) or '-'
+            rows.append([engine, key, '%.3f'%v1, '%.3f'%v2, change])
+    return ascmini.tabulify(rows, 1)
+
+
+#----------------------------------------------------------------------
+# main
+#----------------------------------------------------------------------
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv
+    options, args = ascmini.utils.getopt(argv[1:])
+    if 'h' in options or 'help' in options:
+        print('usage: benchmark.py [--docs=N] [--size=BYTES] [--seed=N]')
+        print('           [--mix=prose:4,code:2,...] [--engines=native,...]')
+        print('           [--repeat=N] [--save=DIR] [--output=FILE]')
+        print('           [--compare=FILE]')
+        print('       benchmark.py --scale=NAME [--steps=N]')
+        print('       benchmark.py --verify=MARKDOWN2.PY [--docs=N] ...')
+        print('features: ' + ', '.join(sorted(FEATURES)))
+        print('scales: ' + ', '.join(sorted(SCALES)))
+        return 0
+    if options.get('scale'):
+        name = options['scale']
+        if name not in SCALES:
+            config.fatal('unknown scale: ' + name)
+        result = scaling(name, int(options.get('steps') or 4))
+        print(scaling_table(name, result))
+        return 0
+    try:
+        mix = parse_mix(options.get('mix'))
+    except ValueError as e:
+        config.fatal(str(e))
+    if options.get('verify'):
+        failed = verify(options['verify'],
+                docs = int(options.get('docs') or 20),
+                size = int(options.get('size') or 16384),
+                seed = int(options.get('seed') or 0), mix = mix)
+        return failed and 1 or 0
+    engines = None
+    if options.get('engines'):
+        engines = [ n.strip() for n in options['engines'].split(',') ]
+    report = run(docs = int(options.get('docs') or 20),
+            size = int(options.get('size') or 16384),
+            seed = int(options.get('seed') or 0),
+            mix = mix, engines = engines,
+            repeat = int(options.get('repeat') or 3),
+            path = options.get('save') or None)
+    print(report_table(report))
+    if options.get('compare'):
+        old = ascmini.load_config(options['compare'])
+        if old is None:
+            config.fatal('can not load: ' + options['compare'])
+        print()
+        print(compare_table(old, report))
+    if options.get('output'):
+        with open(options['output'], 'w') as fp:
+            fp.write(json.dumps(report, indent = 4, sort_keys = True) + '\n')
+    return 0
+
+
+#----------------------------------------------------------------------
+# testing suit
+#----------------------------------------------------------------------
+if __name__ == '__main__':
+    def test1():
+        gen = CorpusGenerator(1)
+        print(gen.document(2048))
+        return 0
+    def test2():
+        report = run(docs = 4, size = 4096, repeat = 1)
+        print(report_table(report))
+        return 0
+    main()
+
+
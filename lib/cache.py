@@ -0,0 +1,191 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#======================================================================
+#
+# cache.py - content addressed disk cache
+#
+#======================================================================
+from __future__ import print_function, unicode_literals
+import sys
+import os
+import hashlib
+import threading
+import ascmini
+
+
+#----------------------------------------------------------------------
+# 2/3 compatible
+#----------------------------------------------------------------------
+if sys.version_info[0] >= 3:
+    unicode = str
+
+
+#----------------------------------------------------------------------
+# digest of key parts
+#----------------------------------------------------------------------
+def digest(*parts):
+    sha = hashlib.sha1()
+    for part in parts:
+        if part is None:
+            part = ''
+        if not isinstance(part, bytes):
+            part = unicode(part).encode('utf-8', 'ignore')
+        sha.update(part)
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+#----------------------------------------------------------------------
+# DiskCache: one file per entry, the least recently used entries will
+# be evicted when total size exceeds the limit.
+#----------------------------------------------------------------------
+class DiskCache (object):
+
+    def __init__ (self, path, limit = 64 * 1024 * 1024):
+        self._path = os.path.abspath(os.path.expanduser(path))
+        self._limit = limit
+        self._lock = threading.Lock()
+        self._size = None
+        self._stats = {'hit': 0, 'miss': 0, 'write': 0, 'evict': 0}
+
+    def __filename (self, key):
+        return os.path.join(self._path, key[:2], key[2:])
+
+    def __scan (self):
+        entries = []
+        if not os.path.isdir(self._path):
+            return entries
+        for root, _, files in os.walk(self._path):
+            for name in files:
+                fn = os.path.join(root, name)
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fn))
+        return entries
+
+    def get (self, key):
+        fn = self.__filename(key)
+        try:
+            with open(fn, 'rb') as fp:
+                content = fp.read()
+            os.utime(fn, None)
+        except (IOError, OSError):
+            content = None
+        with self._lock:
+            self._stats[(content is None) and 'miss' or 'hit'] += 1
+        if content is None:
+            return None
+        return content.decode('utf-8', 'ignore')
+
+    # copy the entry to a file, returns False if it does not exist
+    def copy (self, key, filename):
+        import shutil
+        fn = self.__filename(key)
+        try:
+            shutil.copyfile(fn, filename)
+            os.utime(fn, None)
+            hr = True
+        except (IOError, OSError):
+            hr = False
+        with self._lock:
+            self._stats[hr and 'hit' or 'miss'] += 1
+        return hr
+
+    def put (self, key, text):
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8', 'ignore')
+        if len(text) > self._limit:
+            return False
+        fn = self.__filename(key)
+        dirname = os.path.dirname(fn)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            temp = ascmini.tmpname(fn)
+            with open(temp, 'wb') as fp:
+                fp.write(text)
+            if not ascmini.replace_file(temp, fn):
+                os.remove(temp)
+                return False
+        except (IOError, OSError):
+            return False
+        with self._lock:
+            self._stats['write'] += 1
+            if self._size is not None:
+                self._size += len(text)
+            size = self._size
+        if size is None or size > self._limit:
+            self.evict()
+        return True
+
+    # remove least recently used entries until size is within limit
+    def evict (self):
+        entries = self.__scan()
+        total = sum([ n[1] for n in entries ])
+        count = 0
+        if total > self._limit:
+            entries.sort()
+            for _, size, fn in entries:
+                if total <= self._limit * 3 // 4:
+                    break
+                try:
+                    os.remove(fn)
+                except OSError:
+                    continue
+                total -= size
+                count += 1
+        with self._lock:
+            self._size = total
+            self._stats['evict'] += count
+        return count
+
+    def clear (self):
+        for _, _, fn in self.__scan():
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+        with self._lock:
+            self._size = 0
+        return True
+
+    def stats (self):
+        with self._lock:
+            return dict(self._stats)
+
+
+#----------------------------------------------------------------------
+# named caches under the cache directory
+#----------------------------------------------------------------------
+_caches = {}
+
+def open_cache(name):
+    import config
+    path = config.options['cache']
+    if not path:
+        return None
+    if name not in _caches:
+        limit = int(config.options['cachesize']) * 1024 * 1024
+        _caches[name] = DiskCache(os.path.join(path, name), limit)
+    return _caches[name]
+
+
+#----------------------------------------------------------------------
+# testing suit
+#----------------------------------------------------------------------
+if __name__ == '__main__':
+    def test1():
+        cc = DiskCache('/tmp/markpress/test', 100)
+        key = digest('hello', 'world')
+        print(cc.get(key))
+        cc.put(key, 'hello, world !!')
+        print(cc.get(key))
+        for i in range(10):
+            cc.put(digest(i), '0123456789abcdef')
+        print(cc.stats())
+        return 0
+    test1()
+
+
@@ -11,6 +11,7 @@
 from __future__ import print_function, unicode_literals
 import sys
 import os
+import threading
 import ascmini
 
 
@@ -36,8 +37,30 @@ options['graphviz'] = cfg.option('default', 'graphviz', '').strip()
 options['path'] = cfg.option('default', 'path', '').strip()
 options['extensions'] = cfg.option('default', 'extensions', '').strip()
 options['extras'] = cfg.option('default', 'extras', '').strip()
+options['highlight'] = cfg.option('default', 'highlight', '').strip().lower()
+options['manifest'] = cfg.option('default', 'manifest', '').strip()
+options['permalinks'] = cfg.option('default', 'permalinks', '').strip()
+options['workers'] = cfg.option('default', 'workers', 1)
+options['jobs'] = cfg.option('default', 'jobs', 0)
+options['cache'] = cfg.option('default', 'cache', '').strip()
+options['cachesize'] = cfg.option('default', 'cachesize', 256)
+options['concurrency'] = 1
+options['permalink'] = ''
 options['proxy'] = None
 
+for _name, _default in (('manifest', 'manifest.json'), 
+        ('permalinks', 'permalink.json')):
+    if not options[_name]:
+        options[_name] = os.path.join(os.path.dirname(ININAME), _default)
+    options[_name] = os.path.abspath(os.path.expanduser(options[_name]))
+
+if not options['cache']:
+    options['cache'] = '~/.cache/markpress'
+if options['cache'].lower() in ('off', 'none', 'no', '0'):
+    options['cache'] = ''
+else:
+    options['cache'] = os.path.abspath(os.path.expanduser(options['cache']))
+
 
 #----------------------------------------------------------------------
 # select
@@ -52,6 +75,8 @@ def select(section):
     options['passwd'] = cfg.option(section, 'passwd', '').strip()
     options['blog'] = cfg.option(section, 'blog', '').strip()
     options['proxy'] = cfg.option(section, 'proxy', '').strip()
+    options['concurrency'] = max(1, cfg.option(section, 'concurrency', 1))
+    options['permalink'] = cfg.option(section, 'permalink', '').strip()
     if not options['url']:
         raise ValueError('config error: empty url')
     if not options['user']:
@@ -140,15 +165,40 @@ def proxy(url):
 
 
 #----------------------------------------------------------------------
-# create wp
+# create wp, shared clients are reused across calls for the same site
+# within the same thread
 #----------------------------------------------------------------------
-def wp_client():
+_local = threading.local()
+
+def wp_client(shared = False):
     import wordpress2
     url = options['url']
+    key = (url, options['user'])
+    if shared:
+        if not hasattr(_local, 'clients'):
+            _local.clients = {}
+        if key in _local.clients:
+            return _local.clients[key]
     wp = wordpress2.WordPress(url, options['user'], options['passwd'])
+    if shared:
+        _local.clients[key] = wp
     return wp
 
 
+#----------------------------------------------------------------------
+# home url of the site without trailing slash, the url option may
+# have no scheme or point to xmlrpc.php, as wordpress2 accepts
+#----------------------------------------------------------------------
+def site_url(url = None):
+    url = (url is None) and options['url'] or url
+    if not url.startswith('https://'):
+        if not url.startswith('http://'):
+            url = 'http://' + url
+    if url.endswith('/xmlrpc.php'):
+        url = url[:-len('/xmlrpc.php')]
+    return url.rstrip('/')
+
+
 #----------------------------------------------------------------------
 # testing suit 
 #----------------------------------------------------------------------
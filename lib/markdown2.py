@@ -143,6 +143,14 @@ SECRET_SALT = bytes(randint(0, 1000000))
 def _hash_text(s):
     return 'md5-' + sha256(SECRET_SALT + s.encode("utf-8")).hexdigest()[32:]
 
+# Sentinel for placeholder tokens: a plane-16 private-use character,
+# stripped from the input so a token can never be forged by the text.
+_PLACEHOLDER = u'\U0010fffd'
+
+# Matches a placeholder token of either kind, see Markdown._hash_text().
+_placeholder_re = re.compile(u'md5(?:-[0-9a-f]{32}|%s[0-9a-f]+z)'
+                             % _PLACEHOLDER)
+
 # Table of hash values for escaped characters:
 g_escape_table = dict([(ch, _hash_text(ch))
     for ch in '\\`*_{}[]()>#+-.!'])
@@ -206,6 +214,10 @@ class Markdown(object):
     # (see _ProcessListItems() for details):
     list_level = 0
 
+    # How to generate placeholders for hashed text: "counter" for cheap
+    # per-instance tokens, "sha256" for the salted digest of the text.
+    placeholders = "counter"
+
     _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
 
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
@@ -254,10 +266,35 @@ class Markdown(object):
         self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
         self.cli = cli
 
-        self._escape_table = g_escape_table.copy()
+        self._placeholder_count = 0
+        if self.placeholders == "counter":
+            self._escape_table = dict([(ch, self._hash_text(ch))
+                for ch in g_escape_table])
+        else:
+            self._escape_table = g_escape_table.copy()
         if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+            self._escape_table['"'] = self._hash_text('"')
+            self._escape_table["'"] = self._hash_text("'")
+        self._base_escape_table = self._escape_table.copy()
+        self._base_unescape_table = dict([(v, k)
+            for k, v in self._escape_table.items()])
+        self._unescape_table = self._base_unescape_table.copy()
+        self._code_span_keys = {}
+        self._code_span_sequential = False
+
+    def _hash_text(self, s):
+        """Return a placeholder token for the given text.
+
+        Tokens are unique within this instance and never reused, so
+        entries left from previous documents can not collide.
+        """
+        if self.placeholders != "counter":
+            return _hash_text(s)
+        # Word characters at both ends make the token look like a word
+        # to the span regexes, as the digest does; "z" terminates the
+        # hex counter so no token is a prefix of another.
+        self._placeholder_count += 1
+        return 'md5%s%xz' % (_PLACEHOLDER, self._placeholder_count)
 
     def reset(self):
         self.urls = {}
@@ -266,6 +303,12 @@ class Markdown(object):
         self.html_spans = {}
         self.list_level = 0
         self.extras = self._instance_extras.copy()
+        # Drop code span entries added by the previous document.
+        self._escape_table = self._base_escape_table.copy()
+        self._unescape_table = self._base_unescape_table.copy()
+        self._code_span_keys = {}
+        self._code_span_sequential = False
+        self._toc = None
         if "footnotes" in self.extras:
             self.footnotes = {}
             self.footnote_ids = []
@@ -330,6 +373,10 @@ class Markdown(object):
         text = text.replace("\r\n", "\n")
         text = text.replace("\r", "\n")
 
+        # The placeholder sentinel must not appear in the input.
+        if _PLACEHOLDER in text:
+            text = text.replace(_PLACEHOLDER, "")
+
         # Make sure $text ends with a couple of newlines:
         text += "\n\n"
 
@@ -590,15 +637,15 @@ class Markdown(object):
         return emacs_vars
 
     def _detab_line(self, line):
-        r"""Recusively convert tabs to spaces in a single line.
+        r"""Convert tabs to spaces in a single line.
+
+        Each tab pads to the next multiple of tab_width, which is what
+        str.expandtabs() does in one pass for a line without CR or LF.
 
         Called from _detab()."""
         if '\t' not in line:
             return line
-        chunk1, chunk2 = line.split('\t', 1)
-        chunk1 += (' ' * (self.tab_width - len(chunk1) % self.tab_width))
-        output = chunk1 + chunk2
-        return self._detab_line(output)
+        return line.expandtabs(self.tab_width)
 
     def _detab(self, text):
         r"""Iterate text line by line and convert tabs to spaces.
@@ -617,10 +664,9 @@ class Markdown(object):
         """
         if '\t' not in text:
             return text
-        output = []
-        for line in text.splitlines():
-            output.append(self._detab_line(line))
-        return '\n'.join(output)
+        tab_width = self.tab_width
+        return '\n'.join([line.expandtabs(tab_width)
+                          for line in text.splitlines()])
 
     # I broke out the html5 tags here and add them to _block_tags_a and
     # _block_tags_b.  This way html5 tags are easy to keep track of.
@@ -672,14 +718,14 @@ class Markdown(object):
                 middle = '\n'.join(lines[1:-1])
                 last_line = lines[-1]
                 first_line = first_line[:m.start()] + first_line[m.end():]
-                f_key = _hash_text(first_line)
+                f_key = self._hash_text(first_line)
                 self.html_blocks[f_key] = first_line
-                l_key = _hash_text(last_line)
+                l_key = self._hash_text(last_line)
                 self.html_blocks[l_key] = last_line
                 return ''.join(["\n\n", f_key,
                     "\n\n", middle, "\n\n",
                     l_key, "\n\n"])
-        key = _hash_text(html)
+        key = self._hash_text(html)
         self.html_blocks[key] = html
         return "\n\n" + key + "\n\n"
 
@@ -774,7 +820,7 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
+                key = self._hash_text(html)
                 self.html_blocks[key] = html
                 text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
 
@@ -794,28 +840,9 @@ class Markdown(object):
     def _strip_link_definitions(self, text):
         # Strips link definitions from text, stores the URLs and titles in
         # hash references.
-        less_than_tab = self.tab_width - 1
-
         # Link defs are in the form:
         #   [id]: url "optional title"
-        _link_def_re = re.compile(r"""
-            ^[ ]{0,%d}\[(.+)\]: # id = \1
-              [ \t]*
-              \n?               # maybe *one* newline
-              [ \t]*
-            <?(.+?)>?           # url = \2
-              [ \t]*
-            (?:
-                \n?             # maybe one newline
-                [ \t]*
-                (?<=\s)         # lookbehind for whitespace
-                ['"(]
-                ([^\n]*)        # title = \3
-                ['")]
-                [ \t]*
-            )?  # title is optional
-            (?:\n+|\Z)
-            """ % less_than_tab, re.X | re.M | re.U)
+        _link_def_re = _block_re("link_def", self.tab_width)
         return _link_def_re.sub(self._extract_link_def_sub, text)
 
     def _extract_link_def_sub(self, match):
@@ -908,22 +935,7 @@ class Markdown(object):
             [^note-id]:
                 Text of the note.
         """
-        less_than_tab = self.tab_width - 1
-        footnote_def_re = re.compile(r'''
-            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
-            [ \t]*
-            (                       # footnote text = \2
-              # First line need not start with the spaces.
-              (?:\s*.*\n+)
-              (?:
-                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
-                .*\n+
-              )*
-            )
-            # Lookahead for non-space at line-start, or end of doc.
-            (?:(?=^[ ]{0,%d}\S)|\Z)
-            ''' % (less_than_tab, self.tab_width, self.tab_width),
-            re.X | re.M)
+        footnote_def_re = _block_re("footnote_def", self.tab_width)
         return footnote_def_re.sub(self._extract_footnote_def_sub, text)
 
     _hr_re = re.compile(r'^[ ]{0,3}([-_*][ ]{0,2}){3,}$', re.M)
@@ -984,12 +996,7 @@ class Markdown(object):
         if ">>>" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        _pyshell_block_re = re.compile(r"""
-            ^([ ]{0,%d})>>>[ ].*\n   # first line
-            ^(\1.*\S+.*\n)*         # any number of subsequent lines
-            ^\n                     # ends with a blank line
-            """ % less_than_tab, re.M | re.X)
+        _pyshell_block_re = _block_re("pyshell_block", self.tab_width)
 
         return _pyshell_block_re.sub(self._pyshell_block_sub, text)
 
@@ -1043,29 +1050,7 @@ class Markdown(object):
         """Copying PHP-Markdown and GFM table syntax. Some regex borrowed from
         https://github.com/michelf/php-markdown/blob/lib/Michelf/Markdown.php#L2538
         """
-        less_than_tab = self.tab_width - 1
-        table_re = re.compile(r'''
-                (?:(?<=\n\n)|\A\n?)             # leading blank line
-
-                ^[ ]{0,%d}                      # allowed whitespace
-                (.*[|].*)  \n                   # $1: header row (at least one pipe)
-
-                ^[ ]{0,%d}                      # allowed whitespace
-                (                               # $2: underline row
-                    # underline row with leading bar
-                    (?:  \|\ *:?-+:?\ *  )+  \|?  \n
-                    |
-                    # or, underline row without leading bar
-                    (?:  \ *:?-+:?\ *\|  )+  (?:  \ *:?-+:?\ *  )?  \n
-                )
-
-                (                               # $3: data rows
-                    (?:
-                        ^[ ]{0,%d}(?!\ )         # ensure line begins with 0 to less_than_tab spaces
-                        .*\|.*  \n
-                    )+
-                )
-            ''' % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
+        table_re = _block_re("table", self.tab_width)
         return table_re.sub(self._table_sub, text)
 
     def _wiki_table_sub(self, match):
@@ -1094,12 +1079,7 @@ class Markdown(object):
         if "||" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        wiki_table_re = re.compile(r'''
-            (?:(?<=\n\n)|\A\n?)            # leading blank line
-            ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
-            (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
-            ''' % less_than_tab, re.M | re.X)
+        wiki_table_re = _block_re("wiki_table", self.tab_width)
         return wiki_table_re.sub(self._wiki_table_sub, text)
 
     def _run_span_gamut(self, text):
@@ -1196,7 +1176,7 @@ class Markdown(object):
         for token in self._sorta_html_tokenize_re.split(text):
             if is_html_markup and not _is_auto_link(token):
                 sanitized = self._sanitize_html(token)
-                key = _hash_text(sanitized)
+                key = self._hash_text(sanitized)
                 self.html_spans[key] = sanitized
                 tokens.append(key)
             else:
@@ -1205,9 +1185,19 @@ class Markdown(object):
         return ''.join(tokens)
 
     def _unhash_html_spans(self, text):
-        for key, sanitized in list(self.html_spans.items()):
-            text = text.replace(key, sanitized)
-        return text
+        return self._unhash(text, self.html_spans)
+
+    def _unhash(self, text, table):
+        """Swap the placeholder tokens in text for their value in table.
+
+        A single scan of the text, however many tokens were hashed.
+        """
+        if not table or "md5" not in text:
+            return text
+        def _sub(match):
+            key = match.group(0)
+            return table.get(key, key)
+        return _placeholder_re.sub(_sub, text)
 
     def _sanitize_html(self, s):
         if self.safe_mode == "replace":
@@ -1306,6 +1296,14 @@ class Markdown(object):
         # pos must be `>= anchor_allowed_pos`.
         anchor_allowed_pos = 0
 
+        # The output is collected in `chunks` instead of splicing each
+        # result back into `text`: text[:flushed] has been emitted and
+        # `size` is the length emitted so far, so a position in `text`
+        # is `pos + size - flushed` in the output.
+        chunks = []
+        size = 0
+        flushed = 0
+
         curr_pos = 0
         while True:  # Handle the next link.
             # The next '[' is the start of:
@@ -1359,7 +1357,10 @@ class Markdown(object):
                     result = '<sup class="footnote-ref" id="fnref-%s">' \
                              '<a href="#fn-%s">%s</a></sup>' \
                              % (normed_id, normed_id, len(self.footnote_ids))
-                    text = text[:start_idx] + result + text[p+1:]
+                    chunks.append(text[flushed:start_idx])
+                    chunks.append(result)
+                    size += start_idx - flushed + len(result)
+                    flushed = curr_pos = p+1
                 else:
                     # This id isn't defined, leave the markup alone.
                     curr_pos = p+1
@@ -1368,7 +1369,7 @@ class Markdown(object):
             # Now determine what this is by the remainder.
             p += 1
             if p == text_length:
-                return text
+                break
 
             # Inline anchor or img?
             if text[p] == '(':  # attempt at perf improvement
@@ -1400,9 +1401,11 @@ class Markdown(object):
                                self.empty_element_suffix)
                         if "smarty-pants" in self.extras:
                             result = result.replace('"', self._escape_table['"'])
-                        curr_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
-                    elif start_idx >= anchor_allowed_pos:
+                        chunks.append(text[flushed:start_idx])
+                        chunks.append(result)
+                        size += start_idx - flushed + len(result)
+                        flushed = curr_pos = url_end_idx
+                    elif start_idx + size - flushed >= anchor_allowed_pos:
                         safe_link = self._safe_protocols.match(url) or url.startswith('#')
                         if self.safe_mode and not safe_link:
                             result_head = '<a href="#"%s>' % (title_str)
@@ -1413,9 +1416,10 @@ class Markdown(object):
                             result = result.replace('"', self._escape_table['"'])
                         # <img> allowed from curr_pos on, <a> from
                         # anchor_allowed_pos on.
-                        curr_pos = start_idx + len(result_head)
-                        anchor_allowed_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
+                        text, curr_pos, size, flushed, anchor_allowed_pos = \
+                            self._emit_anchor(chunks, text, size, flushed,
+                                              start_idx, result,
+                                              len(result_head), url_end_idx)
                     else:
                         # Anchor not allowed here.
                         curr_pos = start_idx + 1
@@ -1456,9 +1460,11 @@ class Markdown(object):
                                    self.empty_element_suffix)
                             if "smarty-pants" in self.extras:
                                 result = result.replace('"', self._escape_table['"'])
-                            curr_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
-                        elif start_idx >= anchor_allowed_pos:
+                            chunks.append(text[flushed:start_idx])
+                            chunks.append(result)
+                            size += start_idx - flushed + len(result)
+                            flushed = curr_pos = match.end()
+                        elif start_idx + size - flushed >= anchor_allowed_pos:
                             if self.safe_mode and not self._safe_protocols.match(url):
                                 result_head = '<a href="#"%s>' % (title_str)
                             else:
@@ -1468,9 +1474,10 @@ class Markdown(object):
                                 result = result.replace('"', self._escape_table['"'])
                             # <img> allowed from curr_pos on, <a> from
                             # anchor_allowed_pos on.
-                            curr_pos = start_idx + len(result_head)
-                            anchor_allowed_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
+                            text, curr_pos, size, flushed, anchor_allowed_pos = \
+                                self._emit_anchor(chunks, text, size, flushed,
+                                                  start_idx, result,
+                                                  len(result_head), match.end())
                         else:
                             # Anchor not allowed here.
                             curr_pos = start_idx + 1
@@ -1482,7 +1489,33 @@ class Markdown(object):
             # Otherwise, it isn't markup.
             curr_pos = start_idx + 1
 
-        return text
+        if not chunks:
+            return text
+        chunks.append(text[flushed:])
+        return "".join(chunks)
+
+    def _emit_anchor(self, chunks, text, size, flushed, start_idx, result,
+                     head_len, end_idx):
+        """Emit an anchor for _do_links() and return the new scanning
+        state: (text, curr_pos, size, flushed, anchor_allowed_pos).
+
+        The anchor from `head_len` on (the link text) is scanned again
+        for images. Without any "[" in it the scan goes on at `end_idx`
+        in the same text, otherwise the rest of the text is rebuilt to
+        start with it.
+        """
+        chunks.append(text[flushed:start_idx])
+        size += start_idx - flushed
+        anchor_allowed_pos = size + len(result)
+        tail = result[head_len:]
+        if "[" not in tail:
+            chunks.append(result)
+            return text, end_idx, anchor_allowed_pos, end_idx, \
+                anchor_allowed_pos
+        chunks.append(result[:head_len])
+        size += head_len
+        text = tail + text[end_idx:]
+        return text, 0, size, 0, anchor_allowed_pos
 
     def header_id_from_text(self, text, prefix, n):
         """Generate a header id attribute value from the given header
@@ -1499,7 +1532,7 @@ class Markdown(object):
             None to not have an id attribute and to exclude this header from
             the TOC (if the "toc" extra is specified).
         """
-        header_id = _slugify(text)
+        header_id = self._slugify(text)
         if prefix and isinstance(prefix, base_string_type):
             header_id = prefix + '-' + header_id
 
@@ -1509,6 +1542,27 @@ class Markdown(object):
 
         return header_id
 
+    def _slugify(self, text):
+        """Return _slugify(text) for text that may hold placeholders.
+
+        The sentinel of counter tokens is stripped by _slugify(): each
+        token is swapped for the salted digest of the text it stands
+        for, the "sha256" placeholder, which is added to the same table
+        so the id is unhashed like the rest of the html.
+        """
+        if _PLACEHOLDER not in text:
+            return _slugify(text)
+        tables = (self.html_spans, self.html_blocks, self._unescape_table)
+        def _digest(match):
+            key = match.group(0)
+            for table in tables:
+                if key in table:
+                    digest = _hash_text(table[key])
+                    table[digest] = table[key]
+                    return digest
+            return _hash_text(key)
+        return _slugify(_placeholder_re.sub(_digest, text))
+
     _toc = None
     def _toc_add_entry(self, level, id, name):
         if level > self._toc_depth:
@@ -1595,54 +1649,37 @@ class Markdown(object):
     def _do_lists(self, text):
         # Form HTML ordered (numbered) and unordered (bulleted) lists.
 
-        # Iterate over each *non-overlapping* list match.
+        # Iterate over each *non-overlapping* list match. The output is
+        # collected in chunks and the text itself is never rebuilt, so a
+        # hit beyond the current list stays valid and needn't be searched
+        # again: each pattern scans the document once.
+        list_res = [_block_re(name, self.tab_width, self.list_level > 0)
+                    for name in ("list_ul", "list_ol")]
+        hits = [list_re.search(text) for list_re in list_res]
+        chunks = []
         pos = 0
         while True:
             # Find the *first* hit for either list style (ul or ol). We
             # match ul and ol separately to avoid adjacent lists of different
             # types running into each other (see issue #16).
-            hits = []
-            for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                whole_list = r'''
-                    (                   # \1 = whole list
-                      (                 # \2
-                        [ ]{0,%d}
-                        (%s)            # \3 = first list item marker
-                        [ \t]+
-                        (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
-                      )
-                      (?:.+?)
-                      (                 # \4
-                          \Z
-                        |
-                          \n{2,}
-                          (?=\S)
-                          (?!           # Negative lookahead for another list item marker
-                            [ \t]*
-                            %s[ \t]+
-                          )
-                      )
-                    )
-                ''' % (less_than_tab, marker_pat, marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
-                match = list_re.search(text, pos)
-                if match:
-                    hits.append((match.start(), match))
-            if not hits:
+            match = None
+            for hit in hits:
+                if hit and (match is None or hit.start() < match.start()):
+                    match = hit
+            if match is None:
                 break
-            hits.sort()
-            match = hits[0][1]
             start, end = match.span()
-            middle = self._list_sub(match)
-            text = text[:start] + middle + text[end:]
-            pos = start + len(middle)  # start pos for next attempted match
-
-        return text
+            chunks.append(text[pos:start])
+            chunks.append(self._list_sub(match))
+            pos = end  # start pos for next attempted match
+            for i, hit in enumerate(hits):
+                if hit and hit.start() < pos:
+                    hits[i] = list_res[i].search(text, pos)
+
+        if not chunks:
+            return text
+        chunks.append(text[pos:])
+        return "".join(chunks)
 
     _list_item_re = re.compile(r'''
         (\n)?                   # leading line = \1
@@ -1720,36 +1757,10 @@ class Markdown(object):
         return list_str
 
     def _get_pygments_lexer(self, lexer_name):
-        try:
-            from pygments import lexers, util
-        except ImportError:
-            return None
-        try:
-            return lexers.get_lexer_by_name(lexer_name)
-        except util.ClassNotFound:
-            return None
+        return _pygments_lexer(lexer_name)
 
     def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
-        import pygments
-        import pygments.formatters
-
-        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
-            def _wrap_code(self, inner):
-                """A function for use in a Pygments Formatter which
-                wraps in <code> tags.
-                """
-                yield 0, "<code>"
-                for tup in inner:
-                    yield tup
-                yield 0, "</code>"
-
-            def wrap(self, source, outfile):
-                """Return the source with a code, pre, and div."""
-                return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
-
-        formatter_opts.setdefault("cssclass", "codehilite")
-        formatter = HtmlCodeFormatter(**formatter_opts)
-        return pygments.highlight(codeblock, lexer, formatter)
+        return _highlight_with_pygments(codeblock, lexer, **formatter_opts)
 
     def _code_block_sub(self, match, is_fenced_code_block=False):
         lexer_name = None
@@ -1776,8 +1787,7 @@ class Markdown(object):
         # Use pygments only if not using the highlightjs-lang extra
         if lexer_name and "highlightjs-lang" not in self.extras:
             def unhash_code(codeblock):
-                for key, sanitized in list(self.html_spans.items()):
-                    codeblock = codeblock.replace(key, sanitized)
+                codeblock = self._unhash(codeblock, self.html_spans)
                 replacements = [
                     ("&amp;", "&"),
                     ("&lt;", "<"),
@@ -1821,20 +1831,7 @@ class Markdown(object):
 
     def _do_code_blocks(self, text):
         """Process Markdown `<pre><code>` blocks."""
-        code_block_re = re.compile(r'''
-            (?:\n\n|\A\n?)
-            (               # $1 = the code block -- one or more lines, starting with a space/tab
-              (?:
-                (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
-                .*\n+
-              )+
-            )
-            ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
-            # Lookahead to make sure this block isn't already in a code block.
-            # Needed when syntax highlighting is being used.
-            (?![^<]*\</code\>)
-            ''' % (self.tab_width, self.tab_width),
-            re.M | re.X)
+        code_block_re = _block_re("code_block", self.tab_width)
         return code_block_re.sub(self._code_block_sub, text)
 
     _fenced_code_block_re = re.compile(r'''
@@ -1914,8 +1911,16 @@ class Markdown(object):
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
-        self._escape_table[text] = hashed
+        hashed = self._escape_table.get(text)
+        if hashed is None:
+            hashed = self._hash_text(text)
+            self._escape_table[text] = hashed
+            self._unescape_table[hashed] = text
+            # Indexed by first char for _encode_backslash_escapes().
+            self._code_span_keys.setdefault(text[:1], []).append(text)
+            if not text or "\\" in text:
+                # Matches overlap with other keys, see there.
+                self._code_span_sequential = True
         return hashed
 
     _strike_re = re.compile(r"~~(?=\S)(.+?)(?<=\S)~~", re.S)
@@ -2150,9 +2155,42 @@ class Markdown(object):
         return self._incomplete_tags_re.sub("&lt;\\1", text)
 
     def _encode_backslash_escapes(self, text):
-        for ch, escape in list(self._escape_table.items()):
-            text = text.replace("\\"+ch, escape)
-        return text
+        # Walk the backslashes once: an escaped special char wins, then
+        # the code span texts starting with the next char, in the order
+        # they were hashed.
+        start = text.find("\\")
+        if start < 0:
+            return text
+        table = self._escape_table
+        if self._code_span_sequential:
+            # An empty code span (it eats every backslash left) or one
+            # containing backslashes makes the result depend on the
+            # order of replacements, so replay them one by one.
+            for ch, escape in list(table.items()):
+                text = text.replace("\\" + ch, escape)
+            return text
+        special = self._base_escape_table
+        chunks = []
+        pos = 0
+        while start >= 0:
+            ch = text[start + 1:start + 2]
+            key = None
+            if ch in special:
+                key = ch
+            else:
+                for span in self._code_span_keys.get(ch, ()):
+                    if text.startswith(span, start + 1):
+                        key = span
+                        break
+            if key is None:
+                start = text.find("\\", start + 1)
+                continue
+            chunks.append(text[pos:start])
+            chunks.append(table[key])
+            pos = start + 1 + len(key)
+            start = text.find("\\", pos)
+        chunks.append(text[pos:])
+        return "".join(chunks)
 
     _auto_link_re = re.compile(r'<((https?|ftp):[^\'">\s]+)>', re.I)
     def _auto_link_sub(self, match):
@@ -2229,7 +2267,7 @@ class Markdown(object):
                         .replace('*', self._escape_table['*'])
                         .replace('_', self._escape_table['_']))
                 link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = _hash_text(link)
+                hash = self._hash_text(link)
                 link_from_hash[hash] = link
                 text = text[:start] + hash + text[end:]
         for hash, link in list(link_from_hash.items()):
@@ -2238,9 +2276,7 @@ class Markdown(object):
 
     def _unescape_special_chars(self, text):
         # Swap back in all the special characters we've hidden.
-        for ch, hash in list(self._escape_table.items()):
-            text = text.replace(hash, ch)
-        return text
+        return self._unhash(text, self._unescape_table)
 
     def _outdent(self, text):
         # Remove one level of line-leading tabs or spaces
@@ -2265,6 +2301,251 @@ class MarkdownWithExtras(Markdown):
 # ---- internal support functions
 
 
+# Compiled block-level patterns depend only on the tab width (and for
+# lists on nesting), so they are compiled once per process and shared
+# by all Markdown instances.
+_block_re_cache = {}
+_block_re_stats = {"hit": 0, "miss": 0}
+
+
+def _block_re(name, tab_width, nested=False):
+    """Return the compiled block pattern `name` for the given tab width.
+
+    "nested" selects the sub-list variant of the list patterns.
+    """
+    key = (name, tab_width, nested)
+    regex = _block_re_cache.get(key)
+    if regex is not None:
+        _block_re_stats["hit"] += 1
+        return regex
+    _block_re_stats["miss"] += 1
+    regex = _compile_block_re(name, tab_width, nested)
+    _block_re_cache[key] = regex
+    return regex
+
+
+def _compile_block_re(name, tab_width, nested):
+    less_than_tab = tab_width - 1
+    if name == "link_def":
+        return re.compile(r"""
+            ^[ ]{0,%d}\[(.+)\]: # id = \1
+              [ \t]*
+              \n?               # maybe *one* newline
+              [ \t]*
+            <?(.+?)>?           # url = \2
+              [ \t]*
+            (?:
+                \n?             # maybe one newline
+                [ \t]*
+                (?<=\s)         # lookbehind for whitespace
+                ['"(]
+                ([^\n]*)        # title = \3
+                ['")]
+                [ \t]*
+            )?  # title is optional
+            (?:\n+|\Z)
+            """ % less_than_tab, re.X | re.M | re.U)
+    elif name == "footnote_def":
+        return re.compile(r'''
+            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
+            [ \t]*
+            (                       # footnote text = \2
+              # First line need not start with the spaces.
+              (?:\s*.*\n+)
+              (?:
+                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
+                .*\n+
+              )*
+            )
+            # Lookahead for non-space at line-start, or end of doc.
+            (?:(?=^[ ]{0,%d}\S)|\Z)
+            ''' % (less_than_tab, tab_width, tab_width),
+            re.X | re.M)
+    elif name == "pyshell_block":
+        return re.compile(r"""
+            ^([ ]{0,%d})>>>[ ].*\n   # first line
+            ^(\1.*\S+.*\n)*         # any number of subsequent lines
+            ^\n                     # ends with a blank line
+            """ % less_than_tab, re.M | re.X)
+    elif name == "table":
+        return re.compile(r'''
+                (?:(?<=\n\n)|\A\n?)             # leading blank line
+
+                ^[ ]{0,%d}                      # allowed whitespace
+                (.*[|].*)  \n                   # $1: header row (at least one pipe)
+
+                ^[ ]{0,%d}                      # allowed whitespace
+                (                               # $2: underline row
+                    # underline row with leading bar
+                    (?:  \|\ *:?-+:?\ *  )+  \|?  \n
+                    |
+                    # or, underline row without leading bar
+                    (?:  \ *:?-+:?\ *\|  )+  (?:  \ *:?-+:?\ *  )?  \n
+                )
+
+                (                               # $3: data rows
+                    (?:
+                        ^[ ]{0,%d}(?!\ )         # ensure line begins with 0 to less_than_tab spaces
+                        .*\|.*  \n
+                    )+
+                )
+            ''' % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
+    elif name == "wiki_table":
+        return re.compile(r'''
+            (?:(?<=\n\n)|\A\n?)            # leading blank line
+            ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
+            (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
+            ''' % less_than_tab, re.M | re.X)
+    elif name == "code_block":
+        return re.compile(r'''
+            (?:\n\n|\A\n?)
+            (               # $1 = the code block -- one or more lines, starting with a space/tab
+              (?:
+                (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
+                .*\n+
+              )+
+            )
+            ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
+            # Lookahead to make sure this block isn't already in a code block.
+            # Needed when syntax highlighting is being used.
+            (?![^<]*\</code\>)
+            ''' % (tab_width, tab_width),
+            re.M | re.X)
+    elif name in ("list_ul", "list_ol"):
+        if name == "list_ul":
+            marker_pat = Markdown._marker_ul
+        else:
+            marker_pat = Markdown._marker_ol
+        whole_list = r'''
+            (                   # \1 = whole list
+              (                 # \2
+                [ ]{0,%d}
+                (%s)            # \3 = first list item marker
+                [ \t]+
+                (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
+              )
+              (?:.+?)
+              (                 # \4
+                  \Z
+                |
+                  \n{2,}
+                  (?=\S)
+                  (?!           # Negative lookahead for another list item marker
+                    [ \t]*
+                    %s[ \t]+
+                  )
+              )
+            )
+        ''' % (less_than_tab, marker_pat, marker_pat)
+        if nested:  # sub-list
+            return re.compile("^"+whole_list, re.X | re.M | re.S)
+        return re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
+                          re.X | re.M | re.S)
+    raise ValueError("unknown block pattern: %r" % name)
+
+
+# Pygments lexers are looked up by name through the plugin registry and
+# the formatter class is built on first use, both are kept per process.
+# Formatters are shared by options, highlight() does not change them.
+_pygments_lexers = {}
+_pygments_formatters = {}
+_pygments_formatter_class = None
+
+
+def _pygments_lexer(lexer_name):
+    """Return the cached Pygments lexer for `lexer_name`, or None if
+    Pygments is missing or does not know the name.
+    """
+    try:
+        return _pygments_lexers[lexer_name]
+    except KeyError:
+        pass
+    try:
+        from pygments import lexers, util
+    except ImportError:
+        return None
+    try:
+        lexer = lexers.get_lexer_by_name(lexer_name)
+    except util.ClassNotFound:
+        lexer = None
+    if len(_pygments_lexers) >= 256:
+        _pygments_lexers.clear()
+    _pygments_lexers[lexer_name] = lexer
+    return lexer
+
+
+def _pygments_formatter(**formatter_opts):
+    """Return a shared HtmlCodeFormatter for the given options."""
+    global _pygments_formatter_class
+    if _pygments_formatter_class is None:
+        import pygments.formatters
+
+        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
+            def _wrap_code(self, inner):
+                """A function for use in a Pygments Formatter which
+                wraps in <code> tags.
+                """
+                yield 0, "<code>"
+                for tup in inner:
+                    yield tup
+                yield 0, "</code>"
+
+            def wrap(self, source, outfile=None):
+                """Return the source with a code, pre, and div."""
+                if outfile is None:
+                    # Pygments >= 2.12 adds the div itself
+                    return self._wrap_pre(self._wrap_code(source))
+                return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
+
+        _pygments_formatter_class = HtmlCodeFormatter
+    try:
+        key = tuple(sorted(formatter_opts.items()))
+        formatter = _pygments_formatters.get(key)
+    except TypeError:
+        # unhashable option values (eg. a list of hl_lines)
+        return _pygments_formatter_class(**formatter_opts)
+    if formatter is None:
+        formatter = _pygments_formatter_class(**formatter_opts)
+        _pygments_formatters[key] = formatter
+    return formatter
+
+
+# Optional store of highlighted html: an object with get(key) and
+# put(key, html), eg. a disk cache shared between processes. It is
+# consulted before running Pygments.
+highlight_cache = None
+
+
+def _highlight_key(codeblock, lexer, formatter_opts):
+    import pygments
+    sha = sha256()
+    for part in (__version__, pygments.__version__,
+                 type(lexer).__module__, type(lexer).__name__,
+                 repr(sorted(lexer.options.items())),
+                 repr(sorted(formatter_opts.items())), codeblock):
+        sha.update(part.encode("utf-8", "surrogatepass"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+def _highlight_with_pygments(codeblock, lexer, **formatter_opts):
+    import pygments
+
+    formatter_opts.setdefault("cssclass", "codehilite")
+    cache = highlight_cache
+    key = None
+    if cache is not None:
+        key = _highlight_key(codeblock, lexer, formatter_opts)
+        html = cache.get(key)
+        if html is not None:
+            return html
+    formatter = _pygments_formatter(**formatter_opts)
+    html = pygments.highlight(codeblock, lexer, formatter)
+    if key is not None:
+        cache.put(key, html)
+    return html
+
+
 def calculate_toc_html(toc):
     """Return the HTML for the current TOC.
 
@@ -2384,18 +2665,14 @@ def _dedentlines(lines, tabsize=8, skip_first_line=False):
     margin = None
     for i, line in enumerate(lines):
         if i == 0 and skip_first_line: continue
-        indent = 0
-        for ch in line:
-            if ch == ' ':
-                indent += 1
-            elif ch == '\t':
-                indent += tabsize - (indent % tabsize)
-            elif ch in '\r\n':
-                continue  # skip all-whitespace lines
-            else:
-                break
-        else:
+        rest = line.lstrip(' \t\r\n')
+        if not rest:
             continue  # skip all-whitespace lines
+        # CR and LF in the leading whitespace take no columns
+        indent = line[:len(line) - len(rest)]
+        if '\r' in indent or '\n' in indent:
+            indent = indent.replace('\r', '').replace('\n', '')
+        indent = len(indent.expandtabs(tabsize))
         if DEBUG: print("dedent: indent=%d: %r" % (indent, line))
         if margin is None:
             margin = indent
@@ -2406,6 +2683,10 @@ def _dedentlines(lines, tabsize=8, skip_first_line=False):
     if margin is not None and margin > 0:
         for i, line in enumerate(lines):
             if i == 0 and skip_first_line: continue
+            if line[:margin] == ' ' * margin:
+                # the common case: the margin is made of spaces only
+                lines[i] = line[margin:]
+                continue
             removed = 0
             for j, ch in enumerate(line):
                 if ch == ' ':
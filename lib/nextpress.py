@@ -15,19 +15,29 @@ import time
 import config
 import ascmini
 import utils
+import profiler
+
+
+#----------------------------------------------------------------------
+# extension names of markdown files
+#----------------------------------------------------------------------
+MARKDOWN_EXTNAMES = ['.md', '.markdown', '.mkd', '.mdown']
 
 
 #----------------------------------------------------------------------
 # markdown render 
 #----------------------------------------------------------------------
-def markpress_render(doc):
-    html = doc.convert('config')
+def markpress_render(doc, incremental = False):
+    html = doc.convert('config', incremental)
+    doc._volatile = False
     try:
         import render
     except ImportError:
         return html
     hr = render.HtmlRender(html)
     hr.process_viz()
+    # script output and errors may differ next time
+    doc._volatile = (hr.scripts > 0 or hr.errors > 0)
     return hr.render()
 
 
@@ -52,6 +62,10 @@ def markpress_load(filename):
 # page maker
 #----------------------------------------------------------------------
 def markpress_page_make(html, title):
+    with profiler.span('template'):
+        return _page_make(html, title)
+
+def _page_make(html, title):
     output = ''
     output += '<html>\n<head>\n'
     output += '<meta charset="UTF-8" />\n'
@@ -81,21 +95,16 @@ def markpress_page_make(html, title):
 
 
 #----------------------------------------------------------------------
-# update file
+# build post from document, raises ValueError for invalid meta
 #----------------------------------------------------------------------
-def markpress_update(filename):
-    doc = markpress_load(filename)
-    if not doc:
-        return -1
-    uuid = doc._uuid
+def markpress_post(doc):
+    status = doc._status
+    if status not in ('', 'draft', 'private', 'publish'):
+        raise ValueError('invalid status %s'%status)
     post = {}
-    post['id'] = uuid
+    post['id'] = doc._uuid
     post['title'] = doc._title
     post['content'] = markpress_render(doc)
-    status = doc._status
-    if status not in ('', 'draft', 'private', 'publish'):
-        config.perror(filename, 1, 'invalid status %s'%status)
-        return -3
     post['status'] = status and status or 'draft'
     if doc._cats:
         post['category'] = doc._cats
@@ -105,13 +114,285 @@ def markpress_update(filename):
         post['slug'] = doc._slug
     if doc._date:
         post['date'] = utils.utc_datetime(doc._date)
-    wp = config.wp_client()
-    wp.post_edit(post)
-    pp = wp.post_get(uuid)
+    return post
+
+
+#----------------------------------------------------------------------
+# update file
+#----------------------------------------------------------------------
+def markpress_update(filename, wp = None, manifest = None):
+    doc = markpress_load(filename)
+    if not doc:
+        return -1
+    uuid = doc._uuid
+    if manifest is not None:
+        if manifest.unchanged(doc):
+            print('post uuid=%s unchanged: %s'%(uuid, filename))
+            return 1
+    try:
+        post = markpress_post(doc)
+    except ValueError as e:
+        config.perror(filename, 1, str(e))
+        return -3
+    if wp is None:
+        wp = config.wp_client(True)
+    permalink = utils.Permalink()
+    link = markpress_edit(wp, post, permalink.lookup(doc))
+    # pages with error traces or script output are pushed again next
+    # time, so nothing is recorded for them
+    if not doc._volatile:
+        permalink.update(doc, link)
+        permalink.save()
+        if manifest is not None:
+            manifest.update(doc)
     print('post uuid=%s updated: %s'%(uuid, filename))
-    print('%s'%pp.link) 
+    print('%s'%link) 
+    return 0
+
+
+#----------------------------------------------------------------------
+# edit post, fetch its link within the same multicall round trip
+# if it is unknown
+#----------------------------------------------------------------------
+def markpress_edit(wp, post, link = None):
+    if link:
+        wp.post_edit(post)
+        return link
+    with wp.batch() as batch:
+        hr = batch.post_edit(post)
+        pp = batch.post_get(post['id'])
+    hr.result()
+    return pp.result().link
+
+
+#----------------------------------------------------------------------
+# edit posts within one multicall round trip, fetching the links that
+# are unknown in it too. items are (post, link), returns the link of
+# each post or the exception raised for it
+#----------------------------------------------------------------------
+def markpress_edit_batch(wp, items):
+    calls = 0
+    for post, link in items:
+        calls += (not link) and 2 or 1
+    batch = wp.batch(calls + 1)
+    results = []
+    for post, link in items:
+        hr = batch.post_edit(post)
+        pp = (not link) and batch.post_get(post['id']) or None
+        results.append((hr, pp, link))
+    try:
+        batch.flush()
+    except Exception:
+        # every call is finished with the error
+        pass
+    output = []
+    for hr, pp, link in results:
+        try:
+            hr.result()
+            if pp is not None:
+                link = pp.result().link
+        except Exception as e:
+            link = e
+        output.append(link)
+    return output
+
+
+#----------------------------------------------------------------------
+# open manifest, returns None when forced to update
+#----------------------------------------------------------------------
+def markpress_manifest(force):
+    if force:
+        return None
+    return utils.Manifest()
+
+
+#----------------------------------------------------------------------
+# collect markdown files from directories or glob patterns
+#----------------------------------------------------------------------
+def markpress_collect(names):
+    import glob
+    result = []
+    visit = {}
+    for name in names:
+        if os.path.isdir(name):
+            files = ascmini.posix.find(name, MARKDOWN_EXTNAMES)
+        elif os.path.exists(name):
+            files = [name]
+        else:
+            files = glob.glob(name)
+        files.sort()
+        for fn in files:
+            fn = os.path.abspath(fn)
+            if fn not in visit:
+                visit[fn] = 1
+                result.append(fn)
+    return result
+
+
+#----------------------------------------------------------------------
+# pipeline workers: render runs in a process pool and the XML-RPC
+# calls run in a thread pool, the edits of rendered posts are queued
+# into shared batches. results are printed by the main thread
+#----------------------------------------------------------------------
+def _pipeline_init(options, profile):
+    config.options.update(options)
+    profiler.enable(profile)
+    profiler.reset()
     return 0
 
+def _pipeline_render(doc):
+    post = markpress_post(doc)
+    post['volatile'] = doc._volatile
+    if profiler.enabled:
+        post['profile'] = profiler.snapshot(True)
+    return post
+
+def _pipeline_edit(items):
+    wp = config.wp_client(True)
+    return markpress_edit_batch(wp, items)
+
+
+#----------------------------------------------------------------------
+# publish files: returns (updated, unchanged, failed)
+#----------------------------------------------------------------------
+def markpress_publish(files, manifest = None):
+    import concurrent.futures
+    import wordpress2
+    workers = config.options['workers']
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(files))
+    concurrency = min(config.options['concurrency'], len(files))
+    if workers > 1:
+        renderer = concurrent.futures.ProcessPoolExecutor(workers,
+                initializer = _pipeline_init,
+                initargs = (dict(config.options), profiler.enabled))
+    else:
+        renderer = concurrent.futures.ThreadPoolExecutor(1)
+    sender = concurrent.futures.ThreadPoolExecutor(concurrency)
+    tasks = {}
+    state = [0, 0, 0]
+    permalink = utils.Permalink()
+    # rendered posts waiting for a batch, and the calls they need
+    pending = []
+    calls = [0]
+    renders = [0]
+    def failed(filename, e):
+        config.perror(filename, 1, '%s: %s'%(type(e).__name__, e))
+        state[2] += 1
+    def send():
+        items = [ (post, link) for doc, post, link in pending ]
+        future = sender.submit(_pipeline_edit, items)
+        tasks[future] = ('edit', [ n[0] for n in pending ])
+        del pending[:]
+        calls[0] = 0
+    def updated(doc, link):
+        filename = doc._filename
+        if isinstance(link, Exception):
+            return failed(filename, link)
+        print('post uuid=%s updated: %s'%(doc._uuid, filename))
+        print('%s'%link)
+        state[0] += 1
+        if not doc._volatile:
+            permalink.update(doc, link)
+            if manifest is not None:
+                manifest.update(doc)
+        if state[0] % 32 == 0:
+            permalink.save()
+            if manifest is not None:
+                manifest.save()
+    try:
+        for filename in files:
+            doc = markpress_load(filename)
+            if not doc:
+                state[2] += 1
+                continue
+            if manifest is not None:
+                if manifest.unchanged(doc):
+                    print('post uuid=%s unchanged: %s'%(doc._uuid, filename))
+                    state[1] += 1
+                    continue
+            future = renderer.submit(_pipeline_render, doc)
+            tasks[future] = ('render', doc)
+            renders[0] += 1
+        while tasks:
+            done, _ = concurrent.futures.wait(tasks, 
+                    return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage, doc = tasks.pop(future)
+                if stage == 'edit':
+                    docs = doc
+                    try:
+                        links = future.result()
+                    except KeyboardInterrupt:
+                        raise
+                    except Exception as e:
+                        links = [ e for n in docs ]
+                    for doc, link in zip(docs, links):
+                        updated(doc, link)
+                    continue
+                renders[0] -= 1
+                filename = doc._filename
+                try:
+                    result = future.result()
+                except KeyboardInterrupt:
+                    raise
+                except ValueError as e:
+                    config.perror(filename, 1, str(e))
+                    state[2] += 1
+                    continue
+                except Exception as e:
+                    failed(filename, e)
+                    continue
+                profiler.merge(result.pop('profile', None))
+                # rendered in another process, doc is a copy there
+                doc._volatile = result.pop('volatile')
+                link = permalink.lookup(doc)
+                pending.append((doc, result, link))
+                calls[0] += (not link) and 2 or 1
+                if calls[0] >= wordpress2.BATCH_SIZE:
+                    send()
+            # nothing more to wait for before sending a partial batch
+            if pending and renders[0] == 0:
+                send()
+    finally:
+        for future in tasks:
+            future.cancel()
+        renderer.shutdown()
+        sender.shutdown()
+        permalink.save()
+        sys.stdout.flush()
+    return tuple(state)
+
+
+#----------------------------------------------------------------------
+# sync a tree of posts within one process
+#----------------------------------------------------------------------
+def markpress_sync(names, force = False):
+    files = markpress_collect(names)
+    if not files:
+        config.perror(' '.join(names), 0, 'no markdown file found')
+        return -1
+    ts = time.time()
+    manifest = markpress_manifest(force)
+    try:
+        success, skipped, failure = markpress_publish(files, manifest)
+    finally:
+        if manifest is not None:
+            manifest.save()
+    elapse = time.time() - ts
+    speed = len(files) / max(elapse, 0.000001)
+    text = 'sync: %d files, %d updated, %d unchanged, %d failed'%(
+        len(files), success, skipped, failure)
+    print('%s in %.2fs (%.2f files/s)'%(text, elapse, speed))
+    if 'wordpress2' in sys.modules:
+        stats = sys.modules['wordpress2'].connection_pool.stats()
+        if stats['request'] > 0:
+            text = 'connections: %d requests, %d opened, %d reused'%(
+                stats['request'], stats['connect'], stats['reuse'])
+            print('%s, %d tls resumed'%(text, stats['resume']))
+    return (failure > 0) and -2 or 0
+
 
 #----------------------------------------------------------------------
 # fetch info
@@ -132,20 +413,246 @@ def markpress_info(filename):
 #----------------------------------------------------------------------
 # convert
 #----------------------------------------------------------------------
-def markpress_compile(filename, outname):
+def markpress_compile(filename, outname, incremental = False):
+    import cache
     doc = markpress_load(filename)
     if not doc:
         return -1
-    doc._html = markpress_render(doc)
-    content = markpress_page_make(doc._html, doc._title)
-    if (not outname) or (outname == '-'):
-        fp = sys.stdout
+    stdout = (not outname) or (outname == '-')
+    store = cache.open_cache('render')
+    if store is not None:
+        key = markpress_render_key(doc)
+        if not stdout:
+            with profiler.span('write'):
+                hit = store.copy(key, outname)
+            profiler.count('render.cache.' + (hit and 'hit' or 'miss'))
+            if hit:
+                return 0
+        else:
+            content = store.get(key)
+            profiler.count('render.cache.' + (content and 'hit' or 'miss'))
+            if content is not None:
+                sys.stdout.write(content)
+                return 0
+    content = markpress_page(doc, incremental)
+    # only full conversions are cached, the page of an incremental one
+    # is not checked against it
+    if store is not None and not doc._volatile and not incremental:
+        store.put(key, content)
+    with profiler.span('write'):
+        if (not outname) or (outname == '-'):
+            fp = sys.stdout
+        else:
+            import codecs
+            fp = codecs.open(outname, 'w', encoding = 'utf-8')
+        fp.write(content)
+        if fp != sys.stdout:
+            fp.close()
+    return 0
+
+
+#----------------------------------------------------------------------
+# build html page, returns None for invalid document
+#----------------------------------------------------------------------
+def markpress_build(filename, incremental = False):
+    doc = markpress_load(filename)
+    if not doc:
+        return None
+    return markpress_page(doc, incremental)
+
+def markpress_page(doc, incremental = False):
+    doc._html = markpress_render(doc, incremental)
+    return markpress_page_make(doc._html, doc._title)
+
+
+#----------------------------------------------------------------------
+# key of the compiled page: the document digest covers content, meta,
+# templates, engine options and the graphviz version for diagrams, the
+# rest is the code that renders it and the versions of the converters
+# it may use
+#----------------------------------------------------------------------
+_render_sources = None
+
+def _render_versions():
+    engine = config.options['engine'].strip().lower()
+    names = []
+    if engine in ('markdown', 'auto'):
+        names.append('markdown')
+    if config.options['highlight'] == 'pygments':
+        names.append('pygments')
+    versions = []
+    for name in names:
+        try:
+            module = __import__(name)
+        except ImportError:
+            module = None
+        versions.append(name + '=' + getattr(module, '__version__', ''))
+    if engine == 'pandoc':
+        try:
+            code, stdout, stderr = ascmini.call(['pandoc', '--version'])
+        except OSError:
+            stdout = b''
+        stdout = stdout.decode('utf-8', 'ignore')
+        versions.append('pandoc=' + stdout.split('\n')[0].strip())
+    return '\n'.join(versions)
+
+def markpress_render_key(doc):
+    import cache
+    global _render_sources
+    if _render_sources is None:
+        import markdown2
+        import render
+        parts = []
+        for module in (markdown2, utils, render, config, ascmini,
+                sys.modules[__name__]):
+            name = os.path.splitext(module.__file__)[0] + '.py'
+            parts.append(ascmini.posix.load_file_content(name, 'rb'))
+        parts.append(_render_versions())
+        _render_sources = cache.digest(*parts)
+    # user extensions of python-markdown
+    name = os.path.expanduser('~/.config/markpress/extensions.py')
+    extensions = ascmini.posix.load_file_content(name, 'rb')
+    return cache.digest('page', doc.digest(), extensions, _render_sources)
+
+
+#----------------------------------------------------------------------
+# watch markdown files and templates
+#----------------------------------------------------------------------
+def _watch_open(names, poll, interval):
+    import watcher
+    home = os.path.expanduser('~/.config/markpress')
+    templates = [ os.path.join(home, n) for n in config.template ]
+    def collect():
+        files = markpress_collect(names)
+        return files + [ n for n in templates if os.path.exists(n) ]
+    roots = [ n for n in names if os.path.isdir(n) ] + [home]
+    for name in names:
+        if not os.path.exists(name):
+            roots.append(os.path.dirname(os.path.abspath(name)))
+    w = watcher.Watcher(collect, roots, interval, 0.1, poll)
+    w.templates = templates
+    return w
+
+# block until files changed, templates are reloaded when they change
+# and every file needs to be rebuilt.
+def _watch_next(w, names):
+    changed = w.wait()
+    if [ n for n in changed if n in w.templates ]:
+        config._load_template()
+        changed = markpress_collect(names)
+    return [ n for n in changed if n not in w.templates ]
+
+
+#----------------------------------------------------------------------
+# watch: recompile changed files in the same process
+#----------------------------------------------------------------------
+def markpress_watch(names, poll = False, interval = 1.0):
+    w = _watch_open(names, poll, interval)
+    def build(files):
+        for fn in files:
+            outname = os.path.splitext(fn)[0] + '.html'
+            ts = time.time()
+            try:
+                hr = markpress_compile(fn, outname, True)
+            except Exception as e:
+                config.perror(fn, 1, str(e))
+                continue
+            if hr == 0:
+                elapse = (time.time() - ts) * 1000
+                print('[%s] %s (%.1f ms)'%(time.strftime('%H:%M:%S'),
+                    outname, elapse))
+        sys.stdout.flush()
+    print('watching %d files (%s), press Ctrl+C to stop'%(
+        len(w.files()) , w.mode))
+    build(markpress_collect(names))
+    try:
+        while True:
+            build(_watch_next(w, names))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        w.close()
+    return 0
+
+
+#----------------------------------------------------------------------
+# deepest directory containing all the files
+#----------------------------------------------------------------------
+def _common_dir(names):
+    dirs = [ os.path.dirname(n) for n in names ]
+    if len(dirs) == 1:
+        return dirs[0]
+    # commonprefix compares characters, cut it at a separator
+    prefix = os.path.commonprefix([ os.path.join(n, '') for n in dirs ])
+    return os.path.dirname(prefix)
+
+
+#----------------------------------------------------------------------
+# serve: local preview, pages are rendered into memory and browsers
+# reload when the page they show is rebuilt
+#----------------------------------------------------------------------
+def markpress_serve(names, address, poll = False, interval = 1.0):
+    import preview
+    import threading
+    import traceback
+    files = markpress_collect(names)
+    if not files:
+        config.fatal('no markdown file found')
+    root = _common_dir(files)
+    # markpress_load() calls config.fatal() for a missing file, which
+    # must not stop the thread watching them
+    def build(filename):
+        try:
+            return markpress_build(filename, True)
+        except SystemExit:
+            pass
+        except Exception as e:
+            config.perror(filename, 1, str(e))
+        return None
+    try:
+        server = preview.PreviewServer(root, build, address,
+                MARKDOWN_EXTNAMES)
+    except (IOError, OSError) as e:
+        config.fatal('cannot listen on %s:%s: %s'%(address[0], address[1], e))
+    w = _watch_open(names, poll, interval)
+    server.update(files)
+    def loop():
+        while True:
+            try:
+                server.update(_watch_next(w, names))
+                server.prune(markpress_collect(names))
+            except Exception:
+                # report and keep watching, browsers would never reload
+                # again once this thread is gone
+                traceback.print_exc()
+                sys.stderr.flush()
+                time.sleep(interval)
+    thread = threading.Thread(target = loop)
+    thread.daemon = True
+    thread.start()
+    url = server.address()
+    if len(files) == 1:
+        url += server.url(files[0])
+    print('serving %s (%s), press Ctrl+C to stop'%(url, w.mode))
+    sys.stdout.flush()
+    markpress_browse(url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+#----------------------------------------------------------------------
+# open url in browser
+#----------------------------------------------------------------------
+def markpress_browse(url):
+    if sys.platform[:3] == 'win':
+        import subprocess
+        subprocess.call(['cmd.exe', '/C', 'start', url])
     else:
-        import codecs
-        fp = codecs.open(outname, 'w', encoding = 'utf-8')
-    fp.write(content)
-    if fp != sys.stdout:
-        fp.close()
+        import webbrowser
+        webbrowser.open(url)
     return 0
 
 
@@ -159,16 +666,7 @@ def markpress_open(filename, preview):
     url = doc.link()
     if preview:
         url = url + '&preview=true'
-    import subprocess
-    subprocess.call(['cmd.exe', '/C', 'start', url])
-    return 0
-
-
-#----------------------------------------------------------------------
-# 
-#----------------------------------------------------------------------
-def markpress_preview(filename):
-    markpress_open(filename, True)
+    markpress_browse(url)
     return 0
 
 
@@ -192,26 +690,63 @@ def main(argv = None):
                 config.fatal(str(e))
     if config.options['proxy']:
         config.proxy(config.options['proxy'])
+    if 'profile' in options:
+        profiler.enable()
+    try:
+        return markpress_main(options, args)
+    finally:
+        if 'profile' in options:
+            markpress_profile(options['profile'])
+
+
+#----------------------------------------------------------------------
+# profile report, dump json to file if name is given
+#----------------------------------------------------------------------
+def markpress_profile(name):
+    sys.stdout.flush()
+    sys.stderr.write(profiler.report() + '\n')
+    sys.stderr.flush()
+    if name:
+        with open(name, 'w') as fp:
+            fp.write(profiler.dumps() + '\n')
+    return 0
+
+
+#----------------------------------------------------------------------
+# operations
+#----------------------------------------------------------------------
+def markpress_main(options, args):
     if 'h' in options or 'help' in options:
         if 'n' in options or 'new' in options:
             print('usage: markpress {-n --new} [--site=SITE] <filename>')
             print('Create a new post and save it to file. Dump to stdout')
             print('if filename is a hyphen (-).')
         elif 'u' in options or 'update' in options:
-            print('usage: markpress {-u --update} [--site=SITE] <filename>')
-            print('Update file to wordpress server')
+            print('usage: markpress {-u --update} [--site=SITE] [--force] <filename>')
+            print('Update file to wordpress server, unchanged files will be')
+            print('skipped unless --force is given')
+        elif 's' in options or 'sync' in options:
+            print('usage: markpress {-s --sync} [--site=SITE] [--force] <dir|glob> ...')
+            print('Update every markdown file in directories or glob')
+            print('patterns to wordpress server within one process')
         elif 'i' in options or 'info' in options:
             print('usage: markpress {-i --info} [--site=SITE] <filename>')
             print('Get post info')
         elif 'c' in options or 'compile' in options:
             print('usage: markpress {-c --compile} [--site=SITE] <filename> [outname]')
             print('Compile markdown to html')
+        elif 'w' in options or 'watch' in options:
+            print('usage: markpress {-w --watch} [--site=SITE] [--poll] [--interval=SEC] <dir|glob> ...')
+            print('Compile markdown files to html and recompile them once')
+            print('they change, until Ctrl+C is pressed')
         elif 'o' in options or 'open' in options:
             print('usage: markpress {-o --open} <filename>')
             print('Open post in browser')
         elif 'p' in options or 'preview' in options:
-            print('usage: markpress {-p --preview} [--site=SITE] <filename>')
-            print('Preview markdown')
+            print('usage: markpress {-p --preview} [--site=SITE] [--port=PORT] [--bind=ADDR] <filename|dir|glob> ...')
+            print('Preview markdown on a local http server, pages in the')
+            print('browser reload once their files change. Use --remote')
+            print('to open the preview of the post on wordpress instead')
         else:
             config.fatal('what help do you need ?')
     elif 'n' in options or 'new' in options:
@@ -225,7 +760,7 @@ def main(argv = None):
                 config.fatal('file already exists: ' + name)
         wp = config.wp_client()
         pid = wp.post_new()
-        pp = wp.post_get(pid)
+        link = config.site_url() + '/?p=' + str(pid)
         if name != '-':
             import codecs
             fp = codecs.open(name, 'w', encoding = 'utf-8')
@@ -239,11 +774,20 @@ def main(argv = None):
         fp.write('---\n\n')
         if name != '-':
             print('new post uuid=%s saved in %s'%(pid, name))
-            print(pp.link)
+            print(link)
     elif 'u' in options or 'update' in options:
         if not args:
             config.fatal('missing file name')
-        markpress_update(args[0])
+        manifest = markpress_manifest('force' in options)
+        markpress_update(args[0], None, manifest)
+        if manifest is not None:
+            manifest.save()
+    elif 's' in options or 'sync' in options:
+        if not args:
+            config.fatal('missing directory name')
+        hr = markpress_sync(args, 'force' in options)
+        if hr != 0:
+            return 1
     elif 'i' in options or 'info' in options:
         if not args:
             config.fatal('missing file name')
@@ -256,6 +800,11 @@ def main(argv = None):
         else:
             outname = os.path.splitext(args[0])[0] + '.html'
         markpress_compile(args[0], outname)
+    elif 'w' in options or 'watch' in options:
+        if not args:
+            config.fatal('missing directory name')
+        interval = float(options.get('interval') or 1.0)
+        markpress_watch(args, 'poll' in options, interval)
     elif 'o' in options or 'open' in options:
         if not args:
             config.fatal('missing file name')
@@ -263,18 +812,27 @@ def main(argv = None):
     elif 'p' in options or 'preview' in options:
         if not args:
             config.fatal('missing file name')
-        markpress_preview(args[0])
+        if 'remote' in options:
+            markpress_open(args[0], True)
+        else:
+            port = int(options.get('port') or 8000)
+            bind = options.get('bind') or '127.0.0.1'
+            interval = float(options.get('interval') or 1.0)
+            markpress_serve(args, (bind, port), 'poll' in options, interval)
     else:
         print('usage: markpress <operation> [...]')
         print('operations:')
         print('    markpress {-n --new} <filename>')
         print('    markpress {-u --update} <filename>')
+        print('    markpress {-s --sync} <dir|glob> ...')
         print('    markpress {-i --info} <filename>')
         print('    markpress {-c --compile} <filename> [outname]')
+        print('    markpress {-w --watch} <dir|glob> ...')
         print('    markpress {-o --open} <filename>')
-        print('    markpress {-p --preview} <filename>')
+        print('    markpress {-p --preview} <filename|dir|glob> ...')
         print()
         print("use 'markpress {-h --help}' with an operation for detail")
+        print("use '--profile[=FILE]' to print time spent in each stage")
     return 0
 
 
@@ -0,0 +1,259 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#======================================================================
+#
+# preview.py - local preview server with push reload
+#
+#======================================================================
+from __future__ import print_function, unicode_literals
+import sys
+import os
+import time
+import threading
+import mimetypes
+
+if sys.version_info[0] >= 3:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, unquote
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse
+    from urllib import unquote
+
+
+#----------------------------------------------------------------------
+# 2/3 compatible
+#----------------------------------------------------------------------
+if sys.version_info[0] >= 3:
+    unicode = str
+
+
+#----------------------------------------------------------------------
+# reload script injected into every page
+#----------------------------------------------------------------------
+EVENTS = '/__events'
+
+RELOAD_SCRIPT = '''<script>
+(function() {
+    var source = new EventSource('%s');
+    source.onmessage = function(e) {
+        if (e.data == decodeURI(location.pathname)) location.reload();
+    };
+})();
+</script>
+''' % EVENTS
+
+
+#----------------------------------------------------------------------
+# request handler: pages from memory, events and static files
+#----------------------------------------------------------------------
+class _Handler (BaseHTTPRequestHandler):
+
+    def log_message (self, format, *args):
+        return None
+
+    def __send (self, code, data, mime):
+        self.send_response(code)
+        self.send_header('Content-Type', mime)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET (self):
+        preview = self.server.preview
+        path = unquote(urlparse(self.path).path)
+        if path == EVENTS:
+            return self.__events(preview)
+        elif path == '/':
+            data = preview.index().encode('utf-8')
+            return self.__send(200, data, 'text/html; charset=utf-8')
+        data = preview.page(path)
+        if data is not None:
+            return self.__send(200, data, 'text/html; charset=utf-8')
+        fn = preview.locate(path)
+        if fn is None:
+            return self.__send(404, b'not found', 'text/plain')
+        try:
+            with open(fn, 'rb') as fp:
+                data = fp.read()
+        except (IOError, OSError):
+            return self.__send(404, b'not found', 'text/plain')
+        mime = mimetypes.guess_type(fn)[0] or 'application/octet-stream'
+        return self.__send(200, data, mime)
+
+    # server-sent events: one line with the url of each rebuilt page
+    def __events (self, preview):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        version = preview.version()
+        try:
+            while True:
+                version, urls = preview.wait(version, 15)
+                if not urls:
+                    self.wfile.write(b': ping\n\n')
+                for url in urls:
+                    self.wfile.write(('data: %s\n\n'%url).encode('utf-8'))
+                self.wfile.flush()
+        except (IOError, OSError):
+            pass
+        return None
+
+
+class _Server (ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+#----------------------------------------------------------------------
+# PreviewServer: keep rendered pages in memory, 'build' takes a file
+# name and returns the page or None, files with one of 'extnames' are
+# sources and never served
+#----------------------------------------------------------------------
+class PreviewServer (object):
+
+    def __init__ (self, root, build, address = ('127.0.0.1', 8000),
+            extnames = ('.md', )):
+        self._root = os.path.abspath(root)
+        self._build = build
+        self._extnames = tuple([ n.lower() for n in extnames ])
+        self._pages = {}        # url -> utf-8 encoded page
+        self._owner = {}        # url -> file name of the page
+        self._hidden = set()    # files whose url belongs to another one
+        self._dirs = set()      # directories of the markdown files
+        self._version = 0
+        self._events = []       # (version, url) of the recent rebuilds
+        self._cond = threading.Condition()
+        self.httpd = _Server(address, _Handler)
+        self.httpd.preview = self
+
+    def url (self, filename):
+        name = os.path.splitext(os.path.abspath(filename))[0] + '.html'
+        name = os.path.relpath(name, self._root).replace(os.sep, '/')
+        return '/' + name
+
+    def address (self):
+        host, port = self.httpd.server_address[:2]
+        if host in ('0.0.0.0', ''):
+            host = '127.0.0.1'
+        return 'http://%s:%d'%(host, port)
+
+    # rebuild pages and notify the browsers showing them
+    def update (self, files):
+        for fn in files:
+            fn = os.path.abspath(fn)
+            self._dirs.add(os.path.dirname(os.path.realpath(fn)))
+            # a.md and a.mkd would both be /a.html, the first one wins
+            url = self.url(fn)
+            owner = self._owner.setdefault(url, fn)
+            if owner != fn:
+                if fn not in self._hidden:
+                    text = '%s is already the page of %s'%(url, owner)
+                    sys.stderr.write('%s:1: error: %s\n'%(fn, text))
+                    sys.stderr.flush()
+                self._hidden.add(fn)
+                continue
+            ts = time.time()
+            page = self._build(fn)
+            if page is None:
+                continue
+            pos = page.rfind('</body>')
+            if pos < 0:
+                pos = len(page)
+            page = page[:pos] + RELOAD_SCRIPT + page[pos:]
+            self._pages[url] = page.encode('utf-8')
+            with self._cond:
+                self._version += 1
+                self._events.append((self._version, url))
+                self._events = self._events[-64:]
+                self._cond.notify_all()
+            elapse = (time.time() - ts) * 1000
+            print('[%s] %s (%.1f ms)'%(time.strftime('%H:%M:%S'), url, elapse))
+        sys.stdout.flush()
+        return True
+
+    # forget pages whose source is gone, and build the files they hid
+    def prune (self, files):
+        names = set([ os.path.abspath(fn) for fn in files ])
+        self._dirs = set([ os.path.dirname(os.path.realpath(fn)) 
+            for fn in names ])
+        for url, owner in list(self._owner.items()):
+            if owner not in names:
+                self._owner.pop(url, None)
+                self._pages.pop(url, None)
+        self._hidden = set([ fn for fn in self._hidden if fn in names ])
+        waiting = [ fn for fn in sorted(self._hidden) 
+            if self.url(fn) not in self._owner ]
+        if waiting:
+            self._hidden.difference_update(waiting)
+            self.update(waiting)
+        return True
+
+    def page (self, url):
+        return self._pages.get(url)
+
+    def index (self):
+        output = ['<html>\n<head>\n<meta charset="UTF-8" />\n</head>\n<body>']
+        output.append('<ul>')
+        for url in sorted(self._pages):
+            output.append('<li><a href="%s">%s</a></li>'%(url, url[1:]))
+        output.append('</ul>\n' + RELOAD_SCRIPT + '</body>\n</html>\n')
+        return '\n'.join(output)
+
+    # static files next to a markdown file or in its sub-directories,
+    # the root may be far above them (even '/') so it is not enough
+    def locate (self, url):
+        parts = url.split('/')
+        if '\0' in url or [ n for n in parts if n.startswith('.') ]:
+            return None
+        name = os.path.join(self._root, *[ n for n in parts if n ])
+        name = os.path.realpath(name)
+        if not os.path.isfile(name):
+            return None
+        if os.path.splitext(name)[-1].lower() in self._extnames:
+            return None
+        for path in list(self._dirs):
+            if name.startswith(os.path.join(path, '')):
+                return name
+        return None
+
+    def version (self):
+        with self._cond:
+            return self._version
+
+    # block until pages are rebuilt, returns (version, urls)
+    def wait (self, version, timeout = None):
+        with self._cond:
+            if self._version == version:
+                self._cond.wait(timeout)
+            urls = [ url for v, url in self._events if v > version ]
+            return self._version, urls
+
+    def serve_forever (self):
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
+        return 0
+
+
+#----------------------------------------------------------------------
+# testing suit
+#----------------------------------------------------------------------
+if __name__ == '__main__':
+    def test1():
+        def build(filename):
+            with open(filename) as fp:
+                return '<html><body><pre>' + fp.read() + '</pre></body></html>'
+        ps = PreviewServer('.', build)
+        ps.update([__file__])
+        print(ps.address() + ps.url(__file__))
+        ps.serve_forever()
+        return 0
+    test1()
+
+
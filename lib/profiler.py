@@ -0,0 +1,195 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#======================================================================
+#
+# profiler.py - stage level timing
+#
+#======================================================================
+from __future__ import print_function, unicode_literals
+import sys
+import time
+import threading
+import ascmini
+
+
+#----------------------------------------------------------------------
+# nanosecond timer
+#----------------------------------------------------------------------
+if hasattr(time, 'perf_counter_ns'):
+    clock = time.perf_counter_ns
+else:
+    _perf_counter = getattr(time, 'perf_counter', time.time)
+    def clock():
+        return int(_perf_counter() * 1000000000)
+
+
+#----------------------------------------------------------------------
+# internal state
+#----------------------------------------------------------------------
+enabled = False
+
+_lock = threading.Lock()
+_spans = {}         # name -> [calls, total, min, max] in nanoseconds
+_counters = {}      # name -> integer
+_start = None
+
+
+#----------------------------------------------------------------------
+# Span: context manager recording elapsed time of a named stage
+#----------------------------------------------------------------------
+class Span (object):
+
+    __slots__ = ('name', 'ts')
+
+    def __init__ (self, name):
+        self.name = name
+        self.ts = 0
+
+    def __enter__ (self):
+        self.ts = clock()
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        record(self.name, clock() - self.ts)
+        return False
+
+
+class _NullSpan (object):
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        return False
+
+_null_span = _NullSpan()
+
+
+#----------------------------------------------------------------------
+# interface
+#----------------------------------------------------------------------
+def enable(state = True):
+    global enabled, _start
+    enabled = state
+    if state and _start is None:
+        _start = clock()
+    return True
+
+def span(name):
+    if not enabled:
+        return _null_span
+    return Span(name)
+
+def record(name, elapse):
+    with _lock:
+        item = _spans.get(name)
+        if item is None:
+            _spans[name] = [1, elapse, elapse, elapse]
+        else:
+            item[0] += 1
+            item[1] += elapse
+            if elapse < item[2]:
+                item[2] = elapse
+            if elapse > item[3]:
+                item[3] = elapse
+    return True
+
+def count(name, value = 1):
+    if not enabled:
+        return False
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+    return True
+
+def reset():
+    global _start
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+    _start = enabled and clock() or None
+    return True
+
+
+#----------------------------------------------------------------------
+# snapshot / merge: move measurements from worker processes
+#----------------------------------------------------------------------
+def snapshot(clear = False):
+    with _lock:
+        spans = dict([ (k, list(v)) for k, v in _spans.items() ])
+        counters = dict(_counters)
+        if clear:
+            _spans.clear()
+            _counters.clear()
+    return {'spans': spans, 'counters': counters}
+
+def merge(data):
+    if not data:
+        return False
+    with _lock:
+        for name, (calls, total, lo, hi) in data['spans'].items():
+            item = _spans.get(name)
+            if item is None:
+                _spans[name] = [calls, total, lo, hi]
+            else:
+                item[0] += calls
+                item[1] += total
+                item[2] = min(item[2], lo)
+                item[3] = max(item[3], hi)
+        for name, value in data['counters'].items():
+            _counters[name] = _counters.get(name, 0) + value
+    return True
+
+
+#----------------------------------------------------------------------
+# report
+#----------------------------------------------------------------------
+def report():
+    data = snapshot()
+    wall = (_start is not None) and (clock() - _start) or 0
+    rows = [['stage', 'calls', 'total(ms)', 'mean(ms)', 'max(ms)', '%']]
+    items = list(data['spans'].items())
+    items.sort(key = lambda n: -n[1][1])
+    for name, (calls, total, lo, hi) in items:
+        ratio = wall and (total * 100.0 / wall) or 0.0
+        rows.append([name, calls, '%.3f'%(total / 1000000.0),
+            '%.3f'%(total / 1000000.0 / calls), '%.3f'%(hi / 1000000.0),
+            '%.1f'%ratio])
+    output = [ascmini.tabulify(rows, 1)]
+    if data['counters']:
+        rows = [['counter', 'value']]
+        for name in sorted(data['counters']):
+            rows.append([name, data['counters'][name]])
+        output.append(ascmini.tabulify(rows, 1))
+    output.append('wall: %.3f ms'%(wall / 1000000.0))
+    return '\n\n'.join(output)
+
+def dumps():
+    import json
+    data = snapshot()
+    wall = (_start is not None) and (clock() - _start) or 0
+    spans = {}
+    for name, (calls, total, lo, hi) in data['spans'].items():
+        spans[name] = {'calls': calls, 'total': total, 'min': lo, 'max': hi}
+    obj = {'unit': 'ns', 'wall': wall, 'argv': sys.argv[1:],
+            'spans': spans, 'counters': data['counters']}
+    return json.dumps(obj, indent = 4, sort_keys = True)
+
+
+#----------------------------------------------------------------------
+# testing suit
+#----------------------------------------------------------------------
+if __name__ == '__main__':
+    def test1():
+        enable()
+        for i in range(10):
+            with span('sleep'):
+                time.sleep(0.01)
+        with span('busy'):
+            sum(range(100000))
+        count('hit', 3)
+        print(report())
+        print(dumps())
+        return 0
+    test1()
+
+
@@ -11,9 +11,11 @@
 from __future__ import print_function, unicode_literals
 import sys
 import os
-import bs4
+import re
 import ascmini
 import config
+import cache
+import profiler
 
 
 #----------------------------------------------------------------------
@@ -21,6 +23,10 @@ import config
 #----------------------------------------------------------------------
 if sys.version_info[0] >= 3:
     unicode = str
+    from html import unescape as _html_unescape
+else:
+    import HTMLParser
+    _html_unescape = HTMLParser.HTMLParser().unescape
 
 
 #----------------------------------------------------------------------
@@ -35,27 +41,62 @@ SCRIPT_PATH = []
 
 
 #----------------------------------------------------------------------
-# GraphViz
+# GraphViz version string of the executable
 #----------------------------------------------------------------------
-def graphviz(engine, text):
-    if engine not in ENGINES:
-        raise ValueError('Invalid Engine: %s'%engine)
+_viz_version = {}
+
+def graphviz_version(exe):
+    if exe not in _viz_version:
+        code, stdout, stderr = ascmini.call([exe, '-V'], None, True)
+        text = stdout and stdout.decode('utf-8', 'ignore') or ''
+        _viz_version[exe] = text.strip()
+    return _viz_version[exe]
+
+
+#----------------------------------------------------------------------
+# GraphViz executable of the engine, None when missing
+#----------------------------------------------------------------------
+def graphviz_exe(engine):
     path = [ n for n in VIZPATH ]
     if config.options['graphviz']:
         viz = config.options['graphviz']
         if os.path.isdir(viz):
             path.append(viz)
-    exe = ascmini.posix.search_cmd(engine, path)
+    return ascmini.posix.search_cmd(engine, path)
+
+# version of the GraphViz rendering viz- blocks, empty when missing
+def graphviz_current():
+    exe = graphviz_exe('dot')
+    return exe and graphviz_version(exe) or ''
+
+
+#----------------------------------------------------------------------
+# GraphViz: svg output is cached by engine, version and source
+#----------------------------------------------------------------------
+def graphviz(engine, text):
+    if engine not in ENGINES:
+        raise ValueError('Invalid Engine: %s'%engine)
+    exe = graphviz_exe(engine)
     if not exe:
         raise FileNotFoundError('Missing GraphViz executable: ' + engine)
+    store = cache.open_cache('graphviz')
+    if store is not None:
+        key = cache.digest(engine, graphviz_version(exe), text)
+        svg = store.get(key)
+        profiler.count('graphviz.cache.' + (svg is None and 'miss' or 'hit'))
+        if svg is not None:
+            return svg
     args = [exe, '-Tsvg']
-    code, stdout, stderr = ascmini.call(args, text)
+    with profiler.span('graphviz'):
+        code, stdout, stderr = ascmini.call(args, text)
     if stdout:
         stdout = stdout.decode('utf-8', 'ignore')
     if stderr:
         stderr = stderr.decode('utf-8', 'ignore')
     if code != 0:
         raise ChildProcessError('error: %s: %s'%(engine, stderr))
+    if store is not None and stdout:
+        store.put(key, stdout)
     return stdout
 
 
@@ -82,7 +123,8 @@ def script_eval(script, text, binary = False):
             encoding = sys.getdefaultencoding()
     if not isinstance(text, bytes):
         text = text.encode(encoding, 'ignore')
-    code, stdout, stderr = ascmini.call([exe], text)
+    with profiler.span('script'):
+        code, stdout, stderr = ascmini.call([exe], text)
     if not binary:
         if stdout:
             stdout = stdout.decode(encoding, 'ignore')
@@ -94,76 +136,153 @@ def script_eval(script, text, binary = False):
 
 
 #----------------------------------------------------------------------
-# render html
+# code block scanner: <pre><code class="..."> spans, the content stops
+# at the first </code> so one match never covers two blocks
+#----------------------------------------------------------------------
+_code_block_re = re.compile(r'''
+    <pre\b[^>]*>\s*<code\b([^>]*)>            # attributes of code
+    ([^<]*(?:<(?!/code>)[^<]*)*)                # content
+    </code>\s*</pre>
+    ''', re.I | re.X)
+
+_code_class_re = re.compile(r'''<code\b[^>]*\bclass\s*=\s*["']?[^"'>]*\b(?:viz|cmd)-''', 
+        re.I)
+
+_class_attr_re = re.compile(r'''\bclass\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', 
+        re.I)
+
+_html_tag_re = re.compile(r'<[^>]*>')
+
+def _html_escape(text):
+    text = text.replace('&', '&amp;')
+    return text.replace('<', '&lt;').replace('>', '&gt;')
+
+# html from svg and scripts, balanced by BeautifulSoup
+def _html_fragment(html):
+    import bs4
+    return unicode(bs4.BeautifulSoup(html, 'html.parser'))
+
+
+#----------------------------------------------------------------------
+# render html: only <pre><code class="viz-.. / cmd-.."> blocks will be
+# rewritten, the rest of the document is kept as it is.
 #----------------------------------------------------------------------
 class HtmlRender (object):
     
     def __init__ (self, html):
         self._origin_html = html
-        self._soup = bs4.BeautifulSoup(html, 'html.parser')
-
-    def process_viz (self):
-        soup = self._soup
-        for pre in soup.find_all('pre'):
-            code = pre.code
-            if code is None:
-                continue
-            if 'class' not in code.attrs:
-                continue
-            if not code['class']:
-                continue
-            engine = None
-            for cls in code['class']:
-                if cls.startswith('viz-'): 
-                    name = cls[4:]
-                    if name in ENGINES:
-                        engine = name
-                        break
-                elif cls.startswith('cmd-') and SCRIPT_ENABLE:
-                    name = str(cls).strip()
-                    mode, _, _ = name[4:].partition('-')
-                    if mode.strip() in ('text', 'html', 'png', 'jpeg'):
-                        engine = name
-                        break
-                elif cls.startswith('language-viz-'):
-                    name = cls[13:]
-                    if name in ENGINES:
-                        engine = name
-                        break
-                elif cls.startswith('language-cmd-') and SCRIPT_ENABLE:
-                    name = str(cls[9:]).strip()
-                    mode, _, _ = name[4:].partition('-')
-                    if mode.strip() in ('text', 'html', 'png', 'jpeg'):
-                        engine = name
-                        break
-            if engine is None:
-                continue
-            # print('engine:', engine)
-            if engine.startswith('cmd-'):
-                tag = self._cmd_replace(engine, code.text)
-            else:
-                tag = self._viz_replace(engine, code.text)
-            pre.insert_before(tag)
-            pre.decompose()
+        self._html = html
+        self.errors = 0         # blocks replaced by a stack trace
+        self.scripts = 0        # blocks evaluated by external scripts
+
+    def _scan (self):
+        html = self._html
+        tasks = []
+        if not _code_class_re.search(html):
+            return tasks
+        for m in _code_block_re.finditer(html):
+            engine = self._viz_engine(m.group(1))
+            if engine is not None:
+                text = _html_unescape(_html_tag_re.sub('', m.group(2)))
+                tasks.append((m.start(), m.end(), engine, text))
+        return tasks
+
+    def process_viz (self, jobs = None):
+        with profiler.span('scan'):
+            tasks = self._scan()
+        if not tasks:
+            return 0
+        if jobs is None:
+            jobs = config.options['jobs']
+        if jobs <= 0:
+            jobs = os.cpu_count() or 1
+        jobs = min(jobs, len(tasks))
+        fetches = [ None for n in tasks ]
+        executor = None
+        if jobs > 1:
+            import concurrent.futures
+            executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        html = self._html
+        output = []
+        try:
+            # dispatch subprocesses first, then splice in document order
+            for index, (_, _, engine, text) in enumerate(tasks):
+                if executor is None:
+                    break
+                if engine.startswith('cmd-'):
+                    future = executor.submit(self._cmd_eval, engine, text)
+                else:
+                    future = executor.submit(graphviz, engine, text)
+                fetches[index] = future.result
+            pos = 0
+            for index, (start, end, engine, text) in enumerate(tasks):
+                # print('engine:', engine)
+                if engine.startswith('cmd-'):
+                    self.scripts += 1
+                    tag = self._cmd_replace(engine, text, fetches[index])
+                else:
+                    tag = self._viz_replace(engine, text, fetches[index])
+                output.append(html[pos:start])
+                output.append(tag)
+                pos = end
+            output.append(html[pos:])
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self._html = ''.join(output)
         return 0
 
-    def _cmd_replace (self, engine, text):
+    def _viz_engine (self, attrs):
+        m = _class_attr_re.search(attrs)
+        if m is None:
+            return None
+        classes = (m.group(1) or m.group(2) or m.group(3) or '').split()
+        for cls in classes:
+            if cls.startswith('viz-'): 
+                name = cls[4:]
+                if name in ENGINES:
+                    return name
+            elif cls.startswith('cmd-') and SCRIPT_ENABLE:
+                name = str(cls).strip()
+                mode, _, _ = name[4:].partition('-')
+                if mode.strip() in ('text', 'html', 'png', 'jpeg'):
+                    return name
+            elif cls.startswith('language-viz-'):
+                name = cls[13:]
+                if name in ENGINES:
+                    return name
+            elif cls.startswith('language-cmd-') and SCRIPT_ENABLE:
+                name = str(cls[9:]).strip()
+                mode, _, _ = name[4:].partition('-')
+                if mode.strip() in ('text', 'html', 'png', 'jpeg'):
+                    return name
+        return None
+
+    def _cmd_eval (self, engine, text):
+        mode, _, script = engine[4:].strip().partition('-')
+        binary = (mode.strip() in ('png', 'jpeg'))
+        return script_eval(script.strip(), text, binary)
+
+    def _error (self):
+        self.errors += 1
+        text = ascmini.callstack()
+        return '<pre><code>' + _html_escape(text) + '</code></pre>'
+
+    # fetch: returns output evaluated in advance, or raises its error
+    def _cmd_replace (self, engine, text, fetch = None):
         mode, _, script = engine[4:].strip().partition('-')
         mode = mode.strip()
-        binary = (mode in ('png', 'jpeg'))
         # print('engine="%s", mode="%s", script="%s"'%(engine, mode, script))
         # print('text', text)
         try:
-            output = script_eval(script.strip(), text, binary)
+            if fetch is not None:
+                output = fetch()
+            else:
+                output = self._cmd_eval(engine, text)
             if mode == 'text':
-                p = self._soup.new_tag('pre')
-                code = self._soup.new_tag('code')
-                p.insert(0, code)
-                code.string = output
+                p = '<pre><code>' + _html_escape(output) + '</code></pre>'
             elif mode == 'html':
-                soup = bs4.BeautifulSoup(output, 'html.parser')
-                p = self._soup.new_tag('p')
-                p.insert(0, soup)
+                p = '<p>' + _html_fragment(output) + '</p>'
             else:
                 import base64
                 html = '<img src="data:image/%s;base64,\n'%mode
@@ -175,40 +294,30 @@ class HtmlRender (object):
                 t = [ s[pos:pos + 76] for pos in xrange(0, len(s), 76) ]
                 t = '\n'.join(t)
                 html = html + t + '"  alt="%s" />\n'%script
-                soup = bs4.BeautifulSoup(html, 'html.parser')
-                p = self._soup.new_tag('p')
-                p.insert(0, soup)
+                p = '<p>' + _html_fragment(html) + '</p>'
         except:
-            text = ascmini.callstack()
-            pre = self._soup.new_tag('pre')
-            code = self._soup.new_tag('code')
-            pre.insert(0, code)
-            code.string = text
-            return pre
+            return self._error()
         return p
 
-    def _viz_replace (self, engine, text):
+    def _viz_replace (self, engine, text, fetch = None):
         try:
-            output = graphviz(engine, text)
+            if fetch is not None:
+                output = fetch()
+            else:
+                output = graphviz(engine, text)
+            import bs4
             soup = bs4.BeautifulSoup(output, 'html.parser')
             # soup = bs4.BeautifulSoup(output, 'lxml')
-            svg = soup.svg.extract()
-            p = self._soup.new_tag('pre')
-            p.insert(0, svg)
-            p['style'] = 'background:none; border:0px; padding: 0.1em;'
+            svg = unicode(soup.svg.extract())
+            style = 'background:none; border:0px; padding: 0.1em;'
+            p = '<pre style="%s">'%style + svg + '</pre>'
             # print(svg)
         except:
-            text = ascmini.callstack()
-            pre = self._soup.new_tag('pre')
-            code = self._soup.new_tag('code')
-            pre.insert(0, code)
-            code.string = text
-            return pre
+            return self._error()
         return p
 
     def render (self):
-        # return self._soup.prettify()
-        return unicode(self._soup)
+        return self._html
 
 
 
@@ -241,7 +350,6 @@ if __name__ == '__main__':
     def test4():
         import utils
         SCRIPT_PATH.append('e:/site/markpress/test/filters')
-        global SCRIPT_ENCODING
         # SCRIPT_ENCODING = 'utf-8'
         doc = utils.MarkdownDoc('../test/1.md')
         html = doc.convert('markdown')
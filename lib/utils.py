@@ -11,10 +11,20 @@
 from __future__ import print_function, unicode_literals
 import sys
 import os
+import re
 import time
+import threading
+import collections
+import bisect
 import config
 import ascmini
 import utime
+import profiler
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
 #----------------------------------------------------------------------
@@ -31,6 +41,15 @@ PANDOC_EXTENSION = ['fancy_lists', 'fenced_code_blocks',
 
 PYMD_EXTENSION = [ 'fenced_code', 'footnotes', 'tables', 'meta' ]
 
+DIGEST_OPTIONS = ['engine', 'tabsize', 'encoding', 'graphviz', 'path',
+    'extensions', 'extras', 'highlight']
+
+# extras that need the whole document at once
+MD_DOCUMENT_EXTRAS = ['toc', 'header-ids', 'numbering']
+
+# extras left to the browser, dropped when highlighting with pygments
+MD_CLIENT_EXTRAS = ['highlightjs-lang']
+
 
 #----------------------------------------------------------------------
 # Error
@@ -39,6 +58,458 @@ class ConvertError (ValueError):
     pass
 
 
+#----------------------------------------------------------------------
+# markdown2 converters are reused by each thread: convert() resets the
+# per-document state, instances keep their extras and tab width.
+#----------------------------------------------------------------------
+_local = threading.local()
+
+def markdown2_converter(extras, tabsize):
+    import markdown2
+    pool = getattr(_local, 'markdown2', None)
+    if pool is None:
+        pool = _local.markdown2 = {}
+    key = (tuple(extras), tabsize)
+    md = pool.get(key)
+    profiler.count('markdown2.pool.' + (md is None and 'miss' or 'hit'))
+    if md is None:
+        md = markdown2.Markdown(extras = extras, tab_width = tabsize)
+        pool[key] = md
+    return md
+
+
+#----------------------------------------------------------------------
+# split markdown into top-level blocks for incremental conversion:
+# chunks between blank lines that markdown2 may treat as one block
+# (lists, quotes, indented lines or html) stay together. returns the
+# blocks and the link definitions as (id, text), or (None, None) when
+# the document can only be converted as a whole.
+#----------------------------------------------------------------------
+_blank_re = re.compile(r'\n(?:[ \t]*\n)+')
+_list_marker_re = re.compile(r'^[ ]{0,3}(?:[*+-]|\d+\.)[ \t]+', re.M)
+_quote_re = re.compile(r'^[ \t]*>', re.M)
+_comment_head_re = re.compile(r'(?:\A|\n\n)[ ]{0,3}\Z')
+_unmask_re = re.compile(r'[^\n]')
+_backslash_re = re.compile(r'\\(.?)', re.S)
+_space_re = re.compile(r'\s+')
+_bracket_re = re.compile(r'[\[\]]')
+_code_head_re = re.compile(r'`+[ \t]*(.?)|^(?:[ ]{4}|\t)[ \t]*(.)', re.S | re.M)
+
+# hide the given spans from later patterns, keeping the line breaks
+def _mask(text, spans):
+    output = []
+    pos = 0
+    for start, end in spans:
+        output.append(text[pos:start])
+        output.append(_unmask_re.sub('x', text[start:end]))
+        pos = end
+    output.append(text[pos:])
+    return ''.join(output)
+
+def _cut(text, spans):
+    output = []
+    pos = 0
+    for start, end in spans:
+        output.append(text[pos:start])
+        pos = end
+    output.append(text[pos:])
+    return ''.join(output)
+
+# html blocks found the way markdown2 hashes them before anything
+# else: they may start at any line and run across blank lines
+def _tag_blocks(text, spans):
+    import markdown2
+    md = markdown2.Markdown
+    for regex, tags in ((md._strict_tag_block_re, md._block_tags_a),
+            (md._liberal_tag_block_re, md._block_tags_b)):
+        found = []
+        # try the lines starting with a tag only, much faster
+        for m in re.finditer(r'^<(?:%s)\b'%tags, text, re.M):
+            if found and m.start() < found[-1][1]:
+                continue
+            m = regex.match(text, m.start())
+            if m is not None:
+                found.append(m.span())
+        text = _mask(text, found)
+        spans.extend(found)
+    return text
+
+def _html_spans(content):
+    spans = []
+    masked = _tag_blocks(content, spans)
+    # markdown2 stops hashing comments after the first one which is
+    # not preceded by a blank line
+    start = masked.find('<!--')
+    while start >= 0:
+        end = masked.find('-->', start)
+        if end < 0:
+            break
+        end += 3
+        spans.append((start, end))
+        standalone = _comment_head_re.search(masked, 0, start)
+        masked = _mask(masked, [(start, end)])
+        start = masked.find('<!--', end)
+        if (not standalone) and start >= 0:
+            return None, None
+    spans.sort()
+    return spans, masked
+
+# link ids are matched case-insensitively, and tabs are expanded
+# depending on the column: compare them without whitespace
+def _link_key(text):
+    return _space_re.sub('', text.lower())
+
+# ids a block may reference: the text between matching brackets for
+# [text][] and the text up to the first ']' for the [id] of [text][id],
+# a superset of what markdown2 looks up
+def _link_ids(block):
+    ids = set()
+    opened = []
+    pending = []
+    for m in _bracket_re.finditer(block):
+        if m.group(0) == '[':
+            opened.append(m.end())
+            pending.append(m.end())
+            continue
+        for start in pending:
+            ids.add(_link_key(block[start:m.start()]))
+        pending = []
+        if opened:
+            ids.add(_link_key(block[opened.pop():m.start()]))
+    return ids
+
+def _block_joins(block, last, text):
+    if text[:1] in (' ', '\t'):
+        return True
+    if _list_marker_re.match(text) and _list_marker_re.search(block):
+        return True
+    if text.lstrip(' ').startswith('>') and _quote_re.search(last):
+        return True
+    return False
+
+def markdown_blocks(content, tabsize = 4, metadata = False):
+    import markdown2
+    content = markdown2.Markdown._ws_only_line_re.sub('', content)
+    # detab drops the final newline, which a trailing <hr> depends on
+    if '\t' in content and '<hr' in content:
+        return None, None
+    # metadata is extracted first, it stays at the head of block 0
+    head = ''
+    if metadata:
+        md = markdown2_converter(['metadata'], tabsize)
+        md.reset()
+        tail = md._extract_metadata(content + '\n\n')
+        size = max(0, len(content) + 2 - len(tail))
+        head, content = content[:size], content[size:]
+        # a fence without metadata is only seen by the whole document
+        if (not head) and content.startswith('---'):
+            return None, None
+    spans, masked = _html_spans(content)
+    if spans is None:
+        return None, None
+    # a backslash may escape the text of any code span or code block
+    # hashed before, even in another block
+    starts = set()
+    for m in _code_head_re.finditer(masked):
+        ch = m.group(1) if m.group(2) is None else m.group(2)
+        starts.add({'<': '&', '>': '&'}.get(ch, ch))
+    for m in _backslash_re.finditer(masked):
+        ch = m.group(1)
+        if ch not in markdown2.g_escape_table:
+            if ch in starts or '`' in starts:
+                return None, None
+    # link definitions are removed with the blank lines after them
+    # before markdown2 looks for blocks, each block gets the ones it
+    # may reference (see _link_ids)
+    link_def = markdown2._block_re('link_def', tabsize)
+    refs = []
+    cuts = []
+    tail = ''
+    pos = 0
+    for m in link_def.finditer(masked):
+        start, end = m.span()
+        tail += content[pos:start]
+        tail = tail[max(0, tail.rfind('\n', 0, len(tail) - 1)):]
+        pos = end
+        # html hashed around a definition sees the lines it joins
+        # in another order, eg. the placeholder ends up in a list
+        if tail and tail[-2:] != '\n\n':
+            line = tail[tail.rfind('\n', 0, len(tail) - 1) + 1:]
+            if content[end:end + 1] == '<' or '<' in line:
+                return None, None
+        index = bisect.bisect(spans, (start, ))
+        if index > 0 and spans[index - 1][1] > start:
+            return None, None
+        if index < len(spans) and spans[index][0] < end:
+            return None, None
+        refs.append((_link_key(m.group(1)), m.group(0).rstrip('\n')))
+        cuts.append((start, end))
+    if cuts:
+        content = _cut(content, cuts)
+        masked = _cut(masked, cuts)
+        starts = [ n[0] for n in cuts ]
+        sizes = [0]
+        for start, end in cuts:
+            sizes.append(sizes[-1] + end - start)
+        spans = [ (n - sizes[bisect.bisect_left(starts, n)],
+            e - sizes[bisect.bisect_left(starts, e)]) for n, e in spans ]
+    # html is hashed again after lists and code blocks are converted,
+    # a tag left open or closed outside html blocks may pair with the
+    # output of another block
+    tags = markdown2.Markdown._block_tags_b
+    if re.search(r'^[ \t]*<(%s)\b|</(%s)>'%(tags, tags), masked, re.M):
+        return None, None
+    blocks = []
+    block = None
+    last = ''
+    sep = ''
+    pos = 0
+    chunks = []
+    index = 0
+    for m in _blank_re.finditer(content):
+        while index < len(spans) and spans[index][1] <= m.start():
+            index += 1
+        inside = index < len(spans) and spans[index][0] < m.start()
+        chunks.append((content[pos:m.start()], m.group(0), inside))
+        pos = m.end()
+    chunks.append((content[pos:], '', False))
+    inside = False
+    for text, next_sep, next_inside in chunks:
+        if block is None:
+            if text.strip():
+                block = text
+                last = text
+            sep = next_sep
+            inside = next_inside
+            continue
+        if inside or _block_joins(block, last, text):
+            block += sep + text
+        else:
+            blocks.append(block)
+            block = text
+        last = text
+        sep = next_sep
+        inside = next_inside
+    if block is not None:
+        blocks.append(block)
+    if head:
+        blocks[:1] = [ head + ''.join(blocks[:1]) ]
+    return blocks, refs
+
+# html is hashed again once lists, quotes and code blocks are converted:
+# a tag left open in the output of one block may pair with a closing
+# tag in the output of a later one, at the start of a line for the
+# strict pattern or at the end of a line for the liberal one
+def _output_tags(html):
+    import markdown2
+    tags = markdown2.Markdown._block_tags_b
+    closed = []
+    for pattern in (r'^</(%s)>[ \t]*$', r'</(%s)>[ \t]*$'):
+        names = re.findall(pattern%tags, html, re.M)
+        closed.append(frozenset(names))
+    # paragraphs were wrapped after that
+    chunks = html.rstrip('\n').split('\n\n')
+    for i, chunk in enumerate(chunks):
+        if chunk.startswith('<p>') and chunk.endswith('</p>'):
+            chunks[i] = chunk[3:-4]
+    masked = '\n\n'.join(chunks)
+    opened = []
+    for regex in (markdown2.Markdown._strict_tag_block_re,
+            markdown2.Markdown._liberal_tag_block_re):
+        masked = _mask(masked, [ m.span() for m in regex.finditer(masked) ])
+        names = re.findall(r'^<(%s)\b'%tags, masked, re.M)
+        opened.append(frozenset(names))
+    return tuple(closed), tuple(opened)
+
+def _output_dangling(items):
+    strict = set()
+    liberal = set()
+    for closed, opened in items:
+        if (strict & closed[0]) or (liberal & closed[1]):
+            return True
+        strict.update(opened[0])
+        liberal.update(opened[1])
+    return False
+
+
+#----------------------------------------------------------------------
+# fenced code blocks: turned into <pre><code> before markdown2 sees
+# them. a fence is two or more backticks or tildes indented by up to
+# three spaces, it is closed by the first line starting with the same
+# fence (so a longer one closes it too and a shorter one is content).
+# trailing spaces of every line are removed, an unclosed block is
+# dropped till the end of the document. 'highlight' takes the code and
+# its language, returns html or None to keep the plain block, the html
+# is escaped like the plain block and set apart by blank lines.
+#----------------------------------------------------------------------
+_fence_open_re = re.compile(r'^[^\S\n]{0,3}(?:``+|~~+)', re.M)
+
+def fenced_code_block(content, tabsize = 4, highlight = None):
+    text = '\n'.join([ n.rstrip('\r\t ') for n in content.split('\n') ])
+    if '``' not in text and '~~' not in text:
+        return text
+    output = []
+    pos = 0
+    size = len(text)
+    while True:
+        m = _fence_open_re.search(text, pos)
+        if m is None:
+            output.append(text[pos:])
+            break
+        start = m.start()
+        mark = m.group(0)
+        eol = text.find('\n', m.end())
+        if eol < 0:
+            eol = size
+        close = text.find('\n' + mark, eol)
+        if close < 0:
+            # unclosed: drop it with the newline before it
+            output.append(text[pos:max(start - 1, pos)])
+            break
+        lang = text[m.end():eol].strip()
+        src = text[eol + 1:close].expandtabs(tabsize).strip('\n')
+        output.append(text[pos:start])
+        pos = text.find('\n', close + 1)
+        html = (lang and highlight) and highlight(src, lang) or None
+        if html is not None:
+            # a block of its own, and no code span if markdown2 still
+            # reads it as inline text
+            html = html.strip('\n').replace('`', '&#96;')
+            output.append('\n\n' + html + '\n\n')
+            if pos < 0:
+                break
+            continue
+        src = src.replace('&', '&amp;').replace('<', '&lt;')
+        src = src.replace('>', '&gt;').replace('`', '&#96;')
+        if lang:
+            output.append('<pre><code class="%s">'%lang)
+        else:
+            output.append('<pre><code>')
+        output.append(src)
+        output.append('\n</code></pre>')
+        if pos < 0:
+            break
+    return ''.join(output)
+
+
+#----------------------------------------------------------------------
+# server-side highlighting with the lexers and formatters cached by
+# markdown2, graphviz and script blocks are left to the renderer.
+#----------------------------------------------------------------------
+def highlight_code(code, lang):
+    import markdown2
+    if lang.startswith('viz-') or lang.startswith('cmd-'):
+        return None
+    if lang.startswith('language-'):
+        return None
+    lexer = markdown2._pygments_lexer(lang)
+    if lexer is None:
+        return None
+    with profiler.span('highlight'):
+        return markdown2._highlight_with_pygments(code, lexer)
+
+
+#----------------------------------------------------------------------
+# HighlightStore: highlighted html in the disk cache, installed as the
+# markdown2.highlight_cache hook
+#----------------------------------------------------------------------
+class HighlightStore (object):
+
+    def __init__ (self, store):
+        self._store = store
+
+    def get (self, key):
+        html = self._store.get(key)
+        profiler.count('highlight.cache.' + (html is None and 'miss' or 'hit'))
+        return html
+
+    def put (self, key, html):
+        return self._store.put(key, html)
+
+def highlight_store():
+    import markdown2
+    import cache
+    if markdown2.highlight_cache is None:
+        store = cache.open_cache('highlight')
+        if store is not None:
+            markdown2.highlight_cache = HighlightStore(store)
+    return markdown2.highlight_cache
+
+
+#----------------------------------------------------------------------
+# BlockCache: converted blocks and the tags they leave open or close,
+# in memory, least recently used entries are dropped first
+#----------------------------------------------------------------------
+class BlockCache (object):
+
+    def __init__ (self, limit = 8192):
+        self._limit = limit
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+        self._queue = None
+
+    def get (self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+        profiler.count('incremental.' + (item is None and 'miss' or 'hit'))
+        return item
+
+    def put (self, key, item):
+        with self._lock:
+            self._items[key] = item
+            self._items.move_to_end(key)
+            while len(self._items) > self._limit:
+                self._items.popitem(False)
+        return True
+
+    def clear (self):
+        with self._lock:
+            self._items.clear()
+        return True
+
+    # convert the blocks of a document converted as a whole in the
+    # background, for the next call
+    def prime (self, tabsize, jobs):
+        with self._lock:
+            if self._queue is None:
+                self._queue = queue.Queue()
+                thread = threading.Thread(target = self.__prime_loop)
+                thread.daemon = True
+                thread.start()
+        for names, used, block, key, item in jobs:
+            self._queue.put((names, tabsize, used, block, key))
+        return True
+
+    def __prime_loop (self):
+        while True:
+            names, tabsize, used, block, key = self._queue.get()
+            try:
+                with self._lock:
+                    found = key in self._items
+                if not found:
+                    self.put(key, _convert_block(names, tabsize, used, block))
+            finally:
+                self._queue.task_done()
+
+    # wait for the blocks being primed
+    def join (self):
+        if self._queue is not None:
+            self._queue.join()
+        return True
+
+block_cache = BlockCache()
+
+def _convert_block(names, tabsize, used, block):
+    md = markdown2_converter(names, tabsize)
+    html = md.convert(block + '\n\n' + used)
+    # nothing left after removing definitions or metadata
+    if html == '<p></p>\n':
+        html = ''
+    return (html, _output_tags(html))
+
+
 #----------------------------------------------------------------------
 # MarkdownDoc 
 #----------------------------------------------------------------------
@@ -46,7 +517,14 @@ class MarkdownDoc (object):
 
     def __init__ (self, filename):
         self._filename = os.path.abspath(filename)
-        self._content = ascmini.posix.load_file_text(filename)
+        with profiler.span('load'):
+            data = ascmini.posix.load_file_content(filename, 'rb')
+        self._content = None
+        if data is not None:
+            import io
+            with profiler.span('decode'):
+                text = ascmini.posix.load_file_text(io.BytesIO(data))
+            self._content = text
         self._html = None
         self._meta = {}
         self._cats = []
@@ -55,6 +533,7 @@ class MarkdownDoc (object):
         self._title = None
         self._error = None
         self._status = None
+        self._digest = None
         self.__parse()
 
     def __parse_list (self, text):
@@ -121,65 +600,99 @@ class MarkdownDoc (object):
             self._tags = None
         return True
 
-    def _fenced_code_block (self, content, tabsize = 4):
-        import re
-        output = []
-        source = []
-        state = 0
-        mark = ''
-        lang = None
-        p1 = re.compile(r'^\s{0,3}```*')
-        p2 = re.compile(r'^\s{0,3}~~~*')
-        for line in content.split('\n'):
-            line = line.rstrip('\r\n\t ')
-            if state == 0:
-                m1 = re.match(p1, line)
-                m2 = re.match(p2, line)
-                mm = m1 and m1 or m2
-                if not mm:
-                    output.append(line)
-                    continue
-                span = mm.span()
-                mark = line[:span[1]]
-                lang = line[span[1]:].strip()
-                state = 1
-                source = []
-            elif state == 1:
-                if not line.startswith(mark):
-                    source.append(line.expandtabs(tabsize))
-                    continue
-                src = '\n'.join(source).strip('\n')
-                head = '<pre><code>'
-                if lang:
-                    head = '<pre><code class="%s">'%lang
-                replacements = [
-                    ("&amp;", "&"),
-                    ("&lt;", "<"),
-                    ("&gt;", ">"),
-                    ("&#96;", "`"),
-                ]
-                for new, old in replacements:
-                    src = src.replace(old, new)
-                output.append(head + src)
-                output.append('</code></pre>')
-                state = 0
-        return '\n'.join(output)
+    def _fenced_code_block (self, content, tabsize = 4, highlight = False):
+        if not highlight:
+            return fenced_code_block(content, tabsize)
+        return fenced_code_block(content, tabsize, highlight_code)
 
-    def _convert_default (self, content):
+    def _convert_default (self, content, incremental = False):
         import markdown2
         tabsize = config.options['tabsize']
-        content = self._fenced_code_block(content, tabsize)
+        highlight = (config.options['highlight'] == 'pygments')
+        highlight_store()
+        with profiler.span('fenced'):
+            content = self._fenced_code_block(content, tabsize, highlight)
         extras = [ n for n in MD_EXTRAS ]
+        if highlight:
+            extras = [ n for n in extras if n not in MD_CLIENT_EXTRAS ]
         if config.options['extras']:
             for n in config.options['extras'].split(','):
                 extras.append(n.strip())
-        md = markdown2.Markdown(extras = extras, tab_width = tabsize)
-        html = md.convert(content)
+        stats = markdown2._block_re_stats
+        hit = stats['hit']
+        with profiler.span('convert.markdown2'):
+            if incremental and self._incremental_safe(content, extras):
+                html = self._convert_blocks(content, extras, tabsize)
+            else:
+                md = markdown2_converter(extras, tabsize)
+                html = md.convert(content)
+        profiler.count('markdown2.regex.hit', stats['hit'] - hit)
         if sys.version_info[0] >= 3:
             unicode = str
         text = unicode(html)
         return text
 
+    # footnotes, header ids and file variables span the whole document
+    def _incremental_safe (self, content, extras):
+        for name in MD_DOCUMENT_EXTRAS:
+            if name in extras:
+                return False
+        if 'footnotes' in extras and '[^' in content:
+            return False
+        if 'use-file-vars' in extras:
+            if '-*-' in content or 'Local Variables' in content:
+                return False
+        return True
+
+    # convert dirty blocks only, each one is converted together with
+    # the link definitions it references. when most blocks are dirty
+    # the document is converted as a whole, which is faster, and the
+    # blocks are left for the next call.
+    def _convert_blocks (self, content, extras, tabsize):
+        import cache
+        metadata = ('metadata' in extras)
+        blocks, refs = markdown_blocks(content, tabsize, metadata)
+        if blocks is None or len(blocks) < 2:
+            md = markdown2_converter(extras, tabsize)
+            return md.convert(content)
+        table = {}
+        for name, text in refs:
+            table.setdefault(name, []).append(text)
+        # metadata only exists at the head of the document
+        others = [ n for n in extras if n not in ('metadata', 'use-file-vars') ]
+        jobs = []
+        dirty = 0
+        for index, block in enumerate(blocks):
+            names = (index == 0) and extras or others
+            used = []
+            for name in sorted([ n for n in _link_ids(block) if n in table ]):
+                used.extend(table[name])
+            used = '\n'.join(used)
+            key = cache.digest(','.join(names), tabsize, used, block)
+            item = block_cache.get(key)
+            if item is None:
+                dirty += 1
+            jobs.append((names, used, block, key, item))
+        if dirty * 2 > len(blocks):
+            profiler.count('incremental.full')
+            md = markdown2_converter(extras, tabsize)
+            html = md.convert(content)
+            block_cache.prime(tabsize, [ n for n in jobs if n[4] is None ])
+            return html
+        output = []
+        items = []
+        for names, used, block, key, item in jobs:
+            if item is None:
+                item = _convert_block(names, tabsize, used, block)
+                block_cache.put(key, item)
+            if item[0]:
+                output.append(item[0])
+                items.append(item[1])
+        if _output_dangling(items):
+            md = markdown2_converter(extras, tabsize)
+            return md.convert(content)
+        return '\n'.join(output)
+
     # require: https://github.com/Python-Markdown/markdown/
     def _convert_markdown (self, content):
         import markdown
@@ -200,12 +713,14 @@ class MarkdownDoc (object):
             if 'extension_configs' in extensions.__dict__:
                 argv['extension_configs'] = extensions.extension_configs
         argv['tab_length'] = int(tabsize)
-        html = markdown.markdown(content, **argv)
+        with profiler.span('convert.markdown'):
+            html = markdown.markdown(content, **argv)
         return html
 
     def _convert_pandoc (self, content):
         tabsize = config.options['tabsize']
-        content = self._fenced_code_block(content, tabsize)
+        with profiler.span('fenced'):
+            content = self._fenced_code_block(content, tabsize)
         input = content.encode('utf-8', 'ignore')
         args = ['pandoc', '-f', 'markdown', '-t', 'html']
         args.extend(PANDOC_FLAGS)
@@ -213,7 +728,8 @@ class MarkdownDoc (object):
             if exts[:1] not in ('+', '-'):
                 exts = '+' + exts
             args[2] += exts
-        code, stdout, stderr = ascmini.call(args, input)
+        with profiler.span('convert.pandoc'):
+            code, stdout, stderr = ascmini.call(args, input)
         self._error = None
         if code != 0:
             stderr = stderr.decode('utf-8', 'ignore')
@@ -224,7 +740,8 @@ class MarkdownDoc (object):
         return stdout.decode('utf-8', 'ignore')
 
     # engine: native, markdown, pandoc, auto, config
-    def convert (self, engine):
+    # incremental: reuse html of unchanged blocks (native engine only)
+    def convert (self, engine, incremental = False):
         if engine is None:
             engine = ''
         engine = engine.strip().lower()
@@ -243,7 +760,7 @@ class MarkdownDoc (object):
             return self._convert_markdown(content)
         elif engine == 'pandoc':
             return self._convert_pandoc(content)
-        return self._convert_default(content)
+        return self._convert_default(content, incremental)
 
     def link (self):
         url = config.options['url']
@@ -251,6 +768,170 @@ class MarkdownDoc (object):
             url += '/'
         return url + '?' + self._uuid
 
+    # digest of everything that affects the rendered post
+    def digest (self):
+        if self._digest is not None:
+            return self._digest
+        import hashlib
+        sha = hashlib.sha1()
+        parts = [self._content or '']
+        for name in sorted(config.template.keys()):
+            parts.append(name + '=' + (config.template[name] or ''))
+        for name in DIGEST_OPTIONS:
+            parts.append(name + '=' + str(config.options.get(name, '')))
+        parts.append(','.join(MD_EXTRAS))
+        parts.append(','.join(PANDOC_FLAGS + PANDOC_EXTENSION))
+        parts.append(','.join(PYMD_EXTENSION))
+        # diagrams change with the graphviz in use
+        if 'viz-' in (self._content or ''):
+            import render
+            parts.append('graphviz=' + render.graphviz_current())
+        for part in parts:
+            sha.update(part.encode('utf-8', 'ignore'))
+            sha.update(b'\0')
+        self._digest = sha.hexdigest()
+        return self._digest
+
+
+#----------------------------------------------------------------------
+# PostRegistry: json file with values keyed by site url and post uuid
+#----------------------------------------------------------------------
+class PostRegistry (object):
+
+    def __init__ (self, filename):
+        self._filename = filename
+        self._registry = ascmini.Registry(filename)
+        self._dirty = False
+
+    def _key (self, uuid):
+        url = config.options.get('url', '')
+        return '%s#%s'%(url, str(uuid).strip())
+
+    def get (self, uuid, default = None):
+        return self._registry.get(self._key(uuid), default)
+
+    def set (self, uuid, value):
+        self._registry.set(self._key(uuid), value)
+        self._dirty = True
+        return True
+
+    def remove (self, uuid):
+        key = self._key(uuid)
+        if key in self._registry.registry:
+            del self._registry.registry[key]
+            self._dirty = True
+        return True
+
+    def save (self):
+        if not self._dirty:
+            return False
+        dirname = os.path.dirname(self._filename)
+        if dirname and not os.path.exists(dirname):
+            ascmini.posix.mkdir(dirname)
+        self._registry.save()
+        self._dirty = False
+        return True
+
+
+#----------------------------------------------------------------------
+# Manifest: remember the digest of each post pushed to the server
+#----------------------------------------------------------------------
+class Manifest (PostRegistry):
+
+    def __init__ (self, filename = None):
+        if filename is None:
+            filename = config.options['manifest']
+        super(Manifest, self).__init__(filename)
+
+    def unchanged (self, doc):
+        digest = self.get(doc._uuid)
+        return (digest is not None) and (digest == doc.digest())
+
+    def update (self, doc):
+        return self.set(doc._uuid, doc.digest())
+
+
+#----------------------------------------------------------------------
+# Permalink: cache post links, invalidated when slug/status/date or
+# the title of a post without slug changes
+#----------------------------------------------------------------------
+class Permalink (PostRegistry):
+
+    def __init__ (self, filename = None):
+        if filename is None:
+            filename = config.options['permalinks']
+        super(Permalink, self).__init__(filename)
+
+    def __fingerprint (self, doc):
+        import hashlib
+        parts = [doc._slug or '', doc._status or '', doc._date or '']
+        if not doc._slug:
+            parts.append(doc._title or '')
+        text = '\0'.join(parts).encode('utf-8', 'ignore')
+        return hashlib.sha1(text).hexdigest()
+
+    def lookup (self, doc):
+        link = permalink_make(doc)
+        if link:
+            return link
+        value = self.get(doc._uuid)
+        if not value:
+            return None
+        fingerprint, _, link = value.partition('|')
+        if fingerprint != self.__fingerprint(doc):
+            return None
+        return link
+
+    def update (self, doc, link):
+        return self.set(doc._uuid, self.__fingerprint(doc) + '|' + link)
+
+
+#----------------------------------------------------------------------
+# compute link from the permalink structure of the site, returns None
+# when it can not be determined locally
+#----------------------------------------------------------------------
+PERMALINK_DRAFTS = ('', 'draft', 'pending', 'future')
+
+_slug_re = re.compile(r'^[a-z0-9_]+(?:-[a-z0-9_]+)*$')
+
+def permalink_make(doc, structure = None):
+    if structure is None:
+        structure = config.options.get('permalink', '')
+    if not structure:
+        return None
+    url = config.site_url()
+    uuid = str(doc._uuid).strip()
+    # posts not published yet have no pretty link, private ones do
+    if structure == 'plain' or doc._status in PERMALINK_DRAFTS:
+        return url + '/?p=' + uuid
+    # wordpress sanitizes the slug, only use one already sanitized
+    if '%postname%' in structure:
+        if not _slug_re.match(doc._slug or ''):
+            return None
+    if not doc._date:
+        return None
+    # the same utc date as the post_date_gmt sent with the post, the
+    # local time of this machine is not the timezone of the site
+    ts = utc_datetime(doc._date)
+    names = {
+        'year': '%04d'%ts.year,
+        'monthnum': '%02d'%ts.month,
+        'day': '%02d'%ts.day,
+        'hour': '%02d'%ts.hour,
+        'minute': '%02d'%ts.minute,
+        'second': '%02d'%ts.second,
+        'post_id': uuid,
+        'postname': doc._slug or '',
+    }
+    import re
+    for name in re.findall(r'%(\w+)%', structure):
+        if name not in names:
+            return None
+    link = re.sub(r'%(\w+)%', lambda m: names[m.group(1)], structure)
+    if not link.startswith('/'):
+        link = '/' + link
+    return url + link
+
 
 #----------------------------------------------------------------------
 # utc datetime 
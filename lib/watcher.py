@@ -0,0 +1,258 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#======================================================================
+#
+# watcher.py - file change notification
+#
+#======================================================================
+from __future__ import print_function, unicode_literals
+import sys
+import os
+import time
+import select
+
+
+#----------------------------------------------------------------------
+# 2/3 compatible
+#----------------------------------------------------------------------
+if sys.version_info[0] >= 3:
+    unicode = str
+
+
+#----------------------------------------------------------------------
+# inotify constants
+#----------------------------------------------------------------------
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+IN_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+        IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+
+#----------------------------------------------------------------------
+# Inotify: directory watches through libc, Linux only
+#----------------------------------------------------------------------
+class Inotify (object):
+
+    def __init__ (self):
+        import ctypes
+        import ctypes.util
+        import struct
+        name = ctypes.util.find_library('c') or 'libc.so.6'
+        libc = ctypes.CDLL(name, use_errno = True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not supported')
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                ctypes.c_uint32]
+        libc.inotify_add_watch.restype = ctypes.c_int
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        libc.inotify_rm_watch.restype = ctypes.c_int
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._libc = libc
+        self._fd = fd
+        self._header = struct.Struct('iIII')
+        self._wds = {}          # wd -> path
+        self._paths = {}        # path -> wd
+
+    def add (self, path):
+        path = os.path.abspath(path)
+        if path in self._paths:
+            return True
+        name = path
+        if not isinstance(name, bytes):
+            name = name.encode(sys.getfilesystemencoding(), 'ignore')
+        wd = self._libc.inotify_add_watch(self._fd, name, IN_WATCH_MASK)
+        if wd < 0:
+            return False
+        self._wds[wd] = path
+        self._paths[path] = wd
+        return True
+
+    def remove (self, path):
+        path = os.path.abspath(path)
+        wd = self._paths.pop(path, None)
+        if wd is None:
+            return False
+        self._wds.pop(wd, None)
+        self._libc.inotify_rm_watch(self._fd, wd)
+        return True
+
+    def watching (self):
+        return list(self._paths.keys())
+
+    # returns changed paths, empty list for timeout
+    def read (self, timeout = None):
+        try:
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+        except (OSError, select.error):
+            return []
+        if not readable:
+            return []
+        changes = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except (IOError, OSError):
+                break
+            if not data:
+                break
+            pos = 0
+            size = self._header.size
+            while pos + size <= len(data):
+                wd, mask, _, length = self._header.unpack_from(data, pos)
+                name = data[pos + size:pos + size + length].rstrip(b'\0')
+                pos += size + length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                path = self._wds.get(wd)
+                if path is None:
+                    continue
+                if mask & IN_IGNORED:
+                    self._wds.pop(wd, None)
+                    self._paths.pop(path, None)
+                    continue
+                if name:
+                    name = name.decode(sys.getfilesystemencoding(), 'ignore')
+                    path = os.path.join(path, name)
+                changes.add(path)
+        if overflow:
+            # events lost, every watched directory may have changed
+            return list(self._paths.keys())
+        return list(changes)
+
+    def close (self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._wds = {}
+        self._paths = {}
+        return True
+
+
+#----------------------------------------------------------------------
+# Watcher: report files whose size or mtime changed, events from the
+# kernel will be used when available otherwise fallback to polling.
+# changes within 'delay' seconds are gathered into one batch.
+#----------------------------------------------------------------------
+class Watcher (object):
+
+    def __init__ (self, collect, roots = None, interval = 1.0, delay = 0.1,
+            poll = False):
+        self._collect = collect
+        self._roots = [ os.path.abspath(n) for n in (roots or []) ]
+        self._interval = interval
+        self._delay = delay
+        self._state = {}
+        self._notify = None
+        if (not poll) and sys.platform.startswith('linux'):
+            try:
+                self._notify = Inotify()
+            except (OSError, AttributeError):
+                self._notify = None
+        self.mode = (self._notify is not None) and 'inotify' or 'poll'
+        self.__snapshot()
+
+    def __stat (self, filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    # refresh file list and directory watches
+    def __snapshot (self):
+        files = self._collect()
+        state = {}
+        for fn in files:
+            state[fn] = self.__stat(fn)
+        self._state = state
+        if self._notify is not None:
+            dirs = {}
+            for fn in files:
+                dirs[os.path.dirname(fn)] = 1
+            for path in self._roots:
+                if os.path.isdir(path):
+                    dirs[path] = 1
+            for path in self._notify.watching():
+                if path not in dirs:
+                    self._notify.remove(path)
+            for path in dirs:
+                self._notify.add(path)
+        return files
+
+    # compare with the previous snapshot
+    def __changed (self):
+        previous = self._state
+        self.__snapshot()
+        changed = []
+        for fn, st in self._state.items():
+            if st is not None and previous.get(fn) != st:
+                changed.append(fn)
+        changed.sort()
+        return changed
+
+    # block until some files changed, returns the changed files
+    def wait (self):
+        notify = self._notify
+        while True:
+            if notify is not None:
+                if not notify.read(self._interval):
+                    continue
+                # debounce: gather bursts of writes
+                while notify.read(self._delay):
+                    pass
+                changed = self.__changed()
+            else:
+                time.sleep(self._interval)
+                changed = self.__changed()
+                while changed:
+                    time.sleep(self._delay)
+                    more = self.__changed()
+                    if not more:
+                        break
+                    changed = sorted(set(changed + more))
+            if changed:
+                return changed
+
+    def files (self):
+        return list(self._state.keys())
+
+    def close (self):
+        if self._notify is not None:
+            self._notify.close()
+            self._notify = None
+        return True
+
+
+#----------------------------------------------------------------------
+# testing suit
+#----------------------------------------------------------------------
+if __name__ == '__main__':
+    def test1():
+        def collect():
+            return [ os.path.abspath(n) for n in sys.argv[1:] ]
+        w = Watcher(collect)
+        print('mode:', w.mode)
+        while True:
+            print(w.wait())
+        return 0
+    test1()
+
+
@@ -10,7 +10,190 @@
 #======================================================================
 from __future__ import print_function, unicode_literals
 import sys
+import time
+import threading
 import wordpress_xmlrpc
+import profiler
+
+xmlrpc_client = wordpress_xmlrpc.compat.xmlrpc_client
+http_client = wordpress_xmlrpc.compat.http_client
+
+
+#----------------------------------------------------------------------
+# max calls in one system.multicall
+#----------------------------------------------------------------------
+BATCH_SIZE = 32
+
+# fault code of xml-rpc servers for an unknown method
+FAULT_METHOD_NOT_FOUND = -32601
+
+
+#----------------------------------------------------------------------
+# ConnectionPool: idle keep-alive connections and tls sessions per site
+#----------------------------------------------------------------------
+class ConnectionPool (object):
+
+    # servers drop idle keep-alive connections after a few seconds
+    # (apache: 5s), so idle ones are reused only below that
+    def __init__ (self, limit = 8, timeout = 3):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._sessions = {}
+        self._contexts = {}
+        self._limit = limit
+        self._timeout = timeout
+        self._stats = {'connect': 0, 'reuse': 0, 'request': 0, 'resume': 0}
+
+    def acquire (self, key):
+        now = time.time()
+        with self._lock:
+            self._stats['request'] += 1
+            idle = self._idle.get(key)
+            while idle:
+                conn, ts = idle.pop()
+                if now - ts < self._timeout:
+                    self._stats['reuse'] += 1
+                    return conn
+                conn.close()
+        return None
+
+    def release (self, key, conn):
+        sock = getattr(conn, 'sock', None)
+        if sock is None:
+            return False
+        session = getattr(sock, 'session', None)
+        with self._lock:
+            if session is not None:
+                self._sessions[key] = session
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._limit:
+                idle.append((conn, time.time()))
+                return True
+        conn.close()
+        return False
+
+    # drop the idle connections of a site after one of them went stale
+    def discard (self, key):
+        with self._lock:
+            idle = self._idle.pop(key, [])
+        for conn, _ in idle:
+            conn.close()
+        return len(idle)
+
+    def session (self, key):
+        with self._lock:
+            return self._sessions.get(key)
+
+    # a tls session can only be resumed by the context which created it,
+    # so every connection of one site shares the same ssl context
+    def context (self, key):
+        with self._lock:
+            context = self._contexts.get(key)
+            if context is None:
+                import ssl
+                context = ssl.create_default_context()
+                self._contexts[key] = context
+            return context
+
+    def count (self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats (self):
+        with self._lock:
+            return dict(self._stats)
+
+    def clear (self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for key in idle:
+            for conn, _ in idle[key]:
+                conn.close()
+        return True
+
+connection_pool = ConnectionPool()
+
+
+#----------------------------------------------------------------------
+# HTTPS connection resuming tls sessions from the pool
+#----------------------------------------------------------------------
+class _HTTPSConnection (http_client.HTTPSConnection):
+
+    def connect (self):
+        http_client.HTTPConnection.connect(self)
+        hostname = self._tunnel_host or self.host
+        session = self._pool.session(self._pool_key)
+        self.sock = self._context.wrap_socket(self.sock, 
+                server_hostname = hostname, session = session)
+        if getattr(self.sock, 'session_reused', False):
+            self._pool.count('resume')
+
+
+#----------------------------------------------------------------------
+# KeepAliveTransport: xmlrpc transport sharing pooled connections,
+# sockets are created by socket.socket so proxy patching still works
+#----------------------------------------------------------------------
+class KeepAliveTransport (xmlrpc_client.Transport):
+
+    def __init__ (self, https = False, pool = None):
+        xmlrpc_client.Transport.__init__(self)
+        self._https = https
+        self._pool = (pool is None) and connection_pool or pool
+        self._reused = False
+
+    def __key (self, host):
+        return (self._https and 'https' or 'http', host)
+
+    def make_connection (self, host, fresh = False):
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        key = self.__key(host)
+        conn = (not fresh) and self._pool.acquire(key) or None
+        self._reused = conn is not None
+        if conn is None:
+            chost, self._extra_headers, x509 = self.get_host_info(host)
+            if self._https:
+                context = self._pool.context(key)
+                conn = _HTTPSConnection(chost, None, context = context)
+                conn._pool = self._pool
+                conn._pool_key = key
+            else:
+                conn = http_client.HTTPConnection(chost)
+            self._pool.count('connect')
+        else:
+            _, self._extra_headers, _ = self.get_host_info(host)
+        self._connection = host, conn
+        return conn
+
+    def single_request (self, host, handler, request_body, verbose = False):
+        try:
+            result = xmlrpc_client.Transport.single_request(self, host, 
+                    handler, request_body, verbose)
+        except xmlrpc_client.Fault:
+            self.__release()
+            raise
+        except (IOError, OSError, http_client.HTTPException):
+            reused = self._reused
+            self.close()
+            if not reused:
+                raise
+            # the server closed it while idle, so did it with the others
+            # of the site: retry once on a new connection
+            self._pool.discard(self.__key(host))
+            self.make_connection(host, True)
+            return self.single_request(host, handler, request_body, verbose)
+        except Exception:
+            self.close()
+            raise
+        self.__release()
+        return result
+
+    def __release (self):
+        host, conn = self._connection
+        self._connection = (None, None)
+        if conn is not None:
+            self._pool.release(self.__key(host), conn)
+        return True
 
 
 #----------------------------------------------------------------------
@@ -23,8 +206,12 @@ class WordPress (object):
         self._rpc = self.__parse_url(self._url)
         self._username = username
         self._password = password
+        https = self._rpc.startswith('https://')
+        self._transport = KeepAliveTransport(https)
         self._client = wordpress_xmlrpc.Client(self._rpc,
-                self._username, self._password)
+                self._username, self._password, 
+                transport = self._transport)
+        self._multicall_enable = True
 
     def __url_normalize (self, url):
         if not url.startswith('https://'):
@@ -47,7 +234,7 @@ class WordPress (object):
     # post['tag']: list
     # post['comment']: open/closed
     # post['date']: datetime object in UTC
-    def __convert_post (self, post):
+    def _convert_post (self, post):
         newpost = wordpress_xmlrpc.WordPressPost()
         if post:
             if 'id' in post:
@@ -81,29 +268,29 @@ class WordPress (object):
         return newpost
 
     def post_new (self, post = None):
-        newpost = self.__convert_post(post)
+        newpost = self._convert_post(post)
         action = wordpress_xmlrpc.methods.posts.NewPost(newpost)
-        pid = self._client.call(action)
+        pid = self._call(action)
         return pid
 
     def post_edit (self, post):
         if 'id' not in post:
             raise ValueError('missing id in post')
-        newpost = self.__convert_post(post)
+        newpost = self._convert_post(post)
         pid = post['id']
         action = wordpress_xmlrpc.methods.posts.EditPost(pid, newpost)
-        return self._client.call(action)
+        return self._call(action)
 
     def post_get (self, pid):
         action = wordpress_xmlrpc.methods.posts.GetPost(pid)
-        return self._client.call(action)
+        return self._call(action)
 
     # keys of query: number, offset, orderby, order(ASC/DESC), post_type
     # and post_status
     # returns list of WordPressPost instances
     def post_list (self, query):
         action = wordpress_xmlrpc.methods.posts.GetPosts(query)
-        return self._client.call(action)
+        return self._call(action)
 
     # returns { 'id':xx, 'file':xx, 'url':xx, 'type':xx }
     def media_upload (self, source, name, mime = None):
@@ -132,18 +319,182 @@ class WordPress (object):
         if mime:
             data['type'] = mime
         action = wordpress_xmlrpc.methods.media.UploadFile(data)
-        response = self._client.call(action)
+        response = self._call(action)
         return response
 
     def media_get (self, attachment_id):
         action = wordpress_xmlrpc.methods.media.GetMediaItem(attachment_id)
-        return self._client.call(action)
+        return self._call(action)
 
     # keys of query: number, offset, parent_id, mime_type
     # returns list of WordPressMedia instances
     def media_list (self, query):
         action = wordpress_xmlrpc.methods.media.GetMediaLibrary(query)
-        return self._client.call(action)
+        return self._call(action)
+
+    # queue calls and send them with system.multicall:
+    #     with wp.batch() as batch:
+    #         r1 = batch.post_edit(post)
+    #         r2 = batch.post_get(pid)
+    #     print(r2.result().link)
+    def batch (self, size = None):
+        return WordPressBatch(self, size)
+
+    def _call (self, action):
+        with profiler.span('xmlrpc.' + action.method_name):
+            return self._client.call(action)
+
+    # connection counters: connect, reuse, request, resume
+    def stats (self):
+        return self._transport._pool.stats()
+
+    def _multicall (self, actions):
+        calls = []
+        for action in actions:
+            args = action.get_args(self._client)
+            calls.append({'methodName': action.method_name, 'params': args})
+        with profiler.span('xmlrpc.system.multicall'):
+            return self._client.server.system.multicall(calls)
+
+
+#----------------------------------------------------------------------
+# BatchResult: result of a queued call
+#----------------------------------------------------------------------
+class BatchResult (object):
+
+    def __init__ (self, action):
+        self._action = action
+        self._done = False
+        self._value = None
+        self._error = None
+
+    def done (self):
+        return self._done
+
+    def result (self):
+        if not self._done:
+            raise RuntimeError('batch has not been flushed')
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _finish (self, value, error):
+        self._done = True
+        self._value = value
+        self._error = error
+
+
+#----------------------------------------------------------------------
+# WordPressBatch: flushes every "size" calls and on exit
+#----------------------------------------------------------------------
+class WordPressBatch (object):
+
+    def __init__ (self, wp, size = None):
+        self._wp = wp
+        self._size = (size is None) and BATCH_SIZE or max(1, size)
+        self._queue = []
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self._queue = []
+        return False
+
+    def __len__ (self):
+        return len(self._queue)
+
+    def __push (self, action):
+        result = BatchResult(action)
+        self._queue.append(result)
+        if len(self._queue) >= self._size:
+            self.flush()
+        return result
+
+    def post_edit (self, post):
+        if 'id' not in post:
+            raise ValueError('missing id in post')
+        newpost = self._wp._convert_post(post)
+        methods = wordpress_xmlrpc.methods.posts
+        return self.__push(methods.EditPost(post['id'], newpost))
+
+    def post_get (self, pid):
+        methods = wordpress_xmlrpc.methods.posts
+        return self.__push(methods.GetPost(pid))
+
+    def media_get (self, attachment_id):
+        methods = wordpress_xmlrpc.methods.media
+        return self.__push(methods.GetMediaItem(attachment_id))
+
+    def flush (self):
+        queue, self._queue = self._queue, []
+        if not queue:
+            return 0
+        if not self._wp._multicall_enable:
+            return self.__sequential(queue)
+        try:
+            output = self._wp._multicall([ n._action for n in queue ])
+        except xmlrpc_client.Fault as e:
+            # system.multicall is missing on some hosts, send the calls
+            # one by one from now on, other faults only for this batch
+            if e.faultCode == FAULT_METHOD_NOT_FOUND:
+                self._wp._multicall_enable = False
+            return self.__sequential(queue)
+        except xmlrpc_client.ProtocolError:
+            # filtered or a transient http error, try them one by one
+            return self.__sequential(queue)
+        except Exception as e:
+            for item in queue:
+                item._finish(None, e)
+            raise
+        for index, item in enumerate(queue):
+            if index >= len(output):
+                error = RuntimeError('missing result in multicall')
+                item._finish(None, error)
+                continue
+            value = output[index]
+            if isinstance(value, dict):
+                code = value.get('faultCode', 0)
+                text = value.get('faultString', '')
+                fault = xmlrpc_client.Fault(code, text)
+                item._finish(None, _fault_error(fault))
+                continue
+            try:
+                value = item._action.process_result(value[0])
+            except Exception as e:
+                item._finish(None, e)
+                continue
+            item._finish(value, None)
+        return len(queue)
+
+    def __sequential (self, queue):
+        for index, item in enumerate(queue):
+            try:
+                value = self._wp._call(item._action)
+            except (IOError, OSError, xmlrpc_client.ProtocolError) as e:
+                for rest in queue[index:]:
+                    rest._finish(None, e)
+                raise
+            except Exception as e:
+                item._finish(None, e)
+                continue
+            item._finish(value, None)
+        return len(queue)
+
+
+#----------------------------------------------------------------------
+# map a fault to the exceptions raised by wordpress_xmlrpc.Client.call
+#----------------------------------------------------------------------
+def _fault_error(fault):
+    exceptions = wordpress_xmlrpc.exceptions
+    if fault.faultCode == 403:
+        return exceptions.InvalidCredentialsError(fault.faultString)
+    elif fault.faultCode == 405:
+        return exceptions.XmlrpcDisabledError(fault.faultString)
+    return fault
 
 
 
@@ -0,0 +1,308 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#======================================================================
+#
+# test_markdown2_links.py - links and images spliced by _do_links
+#
+#======================================================================
+from __future__ import print_function, unicode_literals
+import os
+import re
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import markdown2
+import benchmark
+import utils
+from markdown2 import _xml_escape_attr, _html_escape_url
+
+
+def convert(text, **kwargs):
+    return markdown2.Markdown(**kwargs).convert(text)
+
+
+# brackets inside the link text, the outer link wins and the inner one
+# is left as text, same as the upstream markdown2
+def test_nested_brackets():
+    html = convert('[a [b] c](http://x/)')
+    assert html == '<p><a href="http://x/">a [b] c</a></p>\n'
+    html = convert('[outer [inner](http://in/)](http://out/)')
+    assert html == ('<p><a href="http://out/">outer [inner](http://in/)'
+        '</a></p>\n')
+    html = convert('[open [x](http://a/) tail')
+    assert html == '<p>[open <a href="http://a/">x</a> tail</p>\n'
+
+
+def test_reference_links():
+    text = '[text][id] and [id][]\n\n[id]: http://example.com/ "Title"'
+    link = '<a href="http://example.com/" title="Title">%s</a>'
+    assert convert(text) == '<p>%s and %s</p>\n'%(link%'text', link%'id')
+    assert convert('[x][nope] stays') == '<p>[x][nope] stays</p>\n'
+
+
+def test_images():
+    html = convert('![alt](/img.png "T")')
+    assert html == '<p><img src="/img.png" alt="alt" title="T" /></p>\n'
+    html = convert('[![alt](/img.png)](http://x/)')
+    assert html == ('<p><a href="http://x/"><img src="/img.png" alt="alt" />'
+        '</a></p>\n')
+    html = convert('[![alt][img]][link]\n\n[img]: /i.png\n[link]: http://l/')
+    assert html == ('<p><a href="http://l/"><img src="/i.png" alt="alt" />'
+        '</a></p>\n')
+
+
+def test_escaped_brackets():
+    html = convert('\\[not a link\\](http://x/) and [a \\] b](http://y/)')
+    assert html == ('<p>[not a link](http://x/) and '
+        '<a href="http://y/">a ] b</a></p>\n')
+    html = convert('[\\[x\\]](http://z/)')
+    assert html == '<p><a href="http://z/">[x]</a></p>\n'
+
+
+def test_urls():
+    html = convert('[x](<http://a/b c>)')
+    assert html == '<p><a href="http://a/b c">x</a></p>\n'
+    html = convert('[x](http://a/(b))')
+    assert html == '<p><a href="http://a/(b)">x</a></p>\n'
+    html = convert('[x](javascript:alert(1))', safe_mode = 'escape')
+    assert html == '<p><a href="#">x</a></p>\n'
+
+
+# every chunk between the links is kept in order
+def test_many_links():
+    text = ' '.join([ '[l%d](http://h/%d)'%(i, i) for i in range(20) ])
+    html = ' '.join([ '<a href="http://h/%d">l%d</a>'%(i, i)
+        for i in range(20) ])
+    assert convert(text) == '<p>' + html + '</p>\n'
+    html = convert('`[x](y)` [z](http://w/)')
+    assert html == '<p><code>[x](y)</code> <a href="http://w/">z</a></p>\n'
+
+
+#----------------------------------------------------------------------
+# differential: the same html as _do_links() splicing every result back
+# into the text, the implementation before output chunks
+#----------------------------------------------------------------------
+def reference_do_links(self, text):
+    # _do_links() before the output was collected in chunks
+    MAX_LINK_TEXT_SENTINEL = 3000  # markdown2 issue 24
+
+    # `anchor_allowed_pos` is used to support img links inside
+    # anchors, but not anchors inside anchors. An anchor's start
+    # pos must be `>= anchor_allowed_pos`.
+    anchor_allowed_pos = 0
+
+    curr_pos = 0
+    while True:  # Handle the next link.
+        # The next '[' is the start of:
+        # - an inline anchor:   [text](url "title")
+        # - a reference anchor: [text][id]
+        # - an inline img:      ![text](url "title")
+        # - a reference img:    ![text][id]
+        # - a footnote ref:     [^id]
+        #   (Only if 'footnotes' extra enabled)
+        # - a footnote defn:    [^id]: ...
+        #   (Only if 'footnotes' extra enabled) These have already
+        #   been stripped in _strip_footnote_definitions() so no
+        #   need to watch for them.
+        # - a link definition:  [id]: url "title"
+        #   These have already been stripped in
+        #   _strip_link_definitions() so no need to watch for them.
+        # - not markup:         [...anything else...
+        try:
+            start_idx = text.index('[', curr_pos)
+        except ValueError:
+            break
+        text_length = len(text)
+
+        # Find the matching closing ']'.
+        # Markdown.pl allows *matching* brackets in link text so we
+        # will here too. Markdown.pl *doesn't* currently allow
+        # matching brackets in img alt text -- we'll differ in that
+        # regard.
+        bracket_depth = 0
+        for p in range(start_idx+1, min(start_idx+MAX_LINK_TEXT_SENTINEL,
+                                        text_length)):
+            ch = text[p]
+            if ch == ']':
+                bracket_depth -= 1
+                if bracket_depth < 0:
+                    break
+            elif ch == '[':
+                bracket_depth += 1
+        else:
+            # Closing bracket not found within sentinel length.
+            # This isn't markup.
+            curr_pos = start_idx + 1
+            continue
+        link_text = text[start_idx+1:p]
+
+        # Possibly a footnote ref?
+        if "footnotes" in self.extras and link_text.startswith("^"):
+            normed_id = re.sub(r'\W', '-', link_text[1:])
+            if normed_id in self.footnotes:
+                self.footnote_ids.append(normed_id)
+                result = '<sup class="footnote-ref" id="fnref-%s">' \
+                         '<a href="#fn-%s">%s</a></sup>' \
+                         % (normed_id, normed_id, len(self.footnote_ids))
+                text = text[:start_idx] + result + text[p+1:]
+            else:
+                # This id isn't defined, leave the markup alone.
+                curr_pos = p+1
+            continue
+
+        # Now determine what this is by the remainder.
+        p += 1
+        if p == text_length:
+            return text
+
+        # Inline anchor or img?
+        if text[p] == '(':  # attempt at perf improvement
+            url, title, url_end_idx = self._extract_url_and_title(text, p)
+            if url is not None:
+                # Handle an inline anchor or img.
+                is_img = start_idx > 0 and text[start_idx-1] == "!"
+                if is_img:
+                    start_idx -= 1
+
+                # We've got to encode these to avoid conflicting
+                # with italics/bold.
+                url = url.replace('*', self._escape_table['*']) \
+                         .replace('_', self._escape_table['_'])
+                if title:
+                    title_str = ' title="%s"' % (
+                        _xml_escape_attr(title)
+                            .replace('*', self._escape_table['*'])
+                            .replace('_', self._escape_table['_']))
+                else:
+                    title_str = ''
+                if is_img:
+                    img_class_str = self._html_class_str_from_tag("img")
+                    result = '<img src="%s" alt="%s"%s%s%s' \
+                        % (_html_escape_url(url, safe_mode=self.safe_mode),
+                           _xml_escape_attr(link_text),
+                           title_str,
+                           img_class_str,
+                           self.empty_element_suffix)
+                    if "smarty-pants" in self.extras:
+                        result = result.replace('"', self._escape_table['"'])
+                    curr_pos = start_idx + len(result)
+                    text = text[:start_idx] + result + text[url_end_idx:]
+                elif start_idx >= anchor_allowed_pos:
+                    safe_link = self._safe_protocols.match(url) or url.startswith('#')
+                    if self.safe_mode and not safe_link:
+                        result_head = '<a href="#"%s>' % (title_str)
+                    else:
+                        result_head = '<a href="%s"%s>' % (_html_escape_url(url, safe_mode=self.safe_mode), title_str)
+                    result = '%s%s</a>' % (result_head, link_text)
+                    if "smarty-pants" in self.extras:
+                        result = result.replace('"', self._escape_table['"'])
+                    # <img> allowed from curr_pos on, <a> from
+                    # anchor_allowed_pos on.
+                    curr_pos = start_idx + len(result_head)
+                    anchor_allowed_pos = start_idx + len(result)
+                    text = text[:start_idx] + result + text[url_end_idx:]
+                else:
+                    # Anchor not allowed here.
+                    curr_pos = start_idx + 1
+                continue
+
+        # Reference anchor or img?
+        else:
+            match = self._tail_of_reference_link_re.match(text, p)
+            if match:
+                # Handle a reference-style anchor or img.
+                is_img = start_idx > 0 and text[start_idx-1] == "!"
+                if is_img:
+                    start_idx -= 1
+                link_id = match.group("id").lower()
+                if not link_id:
+                    link_id = link_text.lower()  # for links like [this][]
+                if link_id in self.urls:
+                    url = self.urls[link_id]
+                    # We've got to encode these to avoid conflicting
+                    # with italics/bold.
+                    url = url.replace('*', self._escape_table['*']) \
+                             .replace('_', self._escape_table['_'])
+                    title = self.titles.get(link_id)
+                    if title:
+                        title = _xml_escape_attr(title) \
+                            .replace('*', self._escape_table['*']) \
+                            .replace('_', self._escape_table['_'])
+                        title_str = ' title="%s"' % title
+                    else:
+                        title_str = ''
+                    if is_img:
+                        img_class_str = self._html_class_str_from_tag("img")
+                        result = '<img src="%s" alt="%s"%s%s%s' \
+                            % (_html_escape_url(url, safe_mode=self.safe_mode),
+                               _xml_escape_attr(link_text),
+                               title_str,
+                               img_class_str,
+                               self.empty_element_suffix)
+                        if "smarty-pants" in self.extras:
+                            result = result.replace('"', self._escape_table['"'])
+                        curr_pos = start_idx + len(result)
+                        text = text[:start_idx] + result + text[match.end():]
+                    elif start_idx >= anchor_allowed_pos:
+                        if self.safe_mode and not self._safe_protocols.match(url):
+                            result_head = '<a href="#"%s>' % (title_str)
+                        else:
+                            result_head = '<a href="%s"%s>' % (_html_escape_url(url, safe_mode=self.safe_mode), title_str)
+                        result = '%s%s</a>' % (result_head, link_text)
+                        if "smarty-pants" in self.extras:
+                            result = result.replace('"', self._escape_table['"'])
+                        # <img> allowed from curr_pos on, <a> from
+                        # anchor_allowed_pos on.
+                        curr_pos = start_idx + len(result_head)
+                        anchor_allowed_pos = start_idx + len(result)
+                        text = text[:start_idx] + result + text[match.end():]
+                    else:
+                        # Anchor not allowed here.
+                        curr_pos = start_idx + 1
+                else:
+                    # This id isn't defined, leave the markup alone.
+                    curr_pos = match.end()
+                continue
+
+        # Otherwise, it isn't markup.
+        curr_pos = start_idx + 1
+
+    return text
+
+
+class Reference (markdown2.Markdown):
+    _do_links = reference_do_links
+
+
+PIECES = ['[', ']', '(', ')', '![', '[x]', '[id]', '[ID][]', '[id] [id]',
+    '(http://h/)', '(<http://a b>)', '(/i.png "T")', '(javascript:x)',
+    '[^1]', '\\[', '\\]', '`', '*', '_', '"', ' ', ' ', 'text', '\n',
+    '[a [b] c]', '[![i](/i.png)](http://l/)', '[![i][id]][id]']
+
+DEFS = '\n\n[id]: http://example.com/*a*_b_ "T*t*"\n\n[^1]: note\n'
+
+
+def generate(rand, count):
+    texts = []
+    for i in range(count):
+        size = rand.randint(1, 40)
+        text = ''.join([ rand.choice(PIECES) for n in range(size) ])
+        texts.append(text + DEFS)
+    return texts
+
+
+def test_reference_implementation():
+    rand = random.Random(0)
+    texts = generate(rand, 1000)
+    gen = benchmark.CorpusGenerator(0, {'links': 8})
+    texts += [ gen.document(8192, i) for i in range(2) ]
+    texts.append(benchmark.SCALES['links'][0](300))
+    options = [ {'extras': utils.MD_EXTRAS}, {'safe_mode': 'escape'},
+        {'extras': ['smarty-pants', 'footnotes']} ]
+    for kwargs in options:
+        for text in texts:
+            html1 = Reference(**kwargs).convert(text)
+            html2 = markdown2.Markdown(**kwargs).convert(text)
+            assert html2 == html1, text
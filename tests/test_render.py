@@ -0,0 +1,50 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#======================================================================
+#
+# test_render.py - viz-/cmd- code blocks in HtmlRender
+#
+#======================================================================
+from __future__ import print_function, unicode_literals
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import render
+
+
+def process(html, jobs = 1):
+    hr = render.HtmlRender(html)
+    hr.process_viz(jobs)
+    return hr.render()
+
+
+# posts without viz-/cmd- blocks are kept as they are, unbalanced or
+# not, prose or other classes mentioning them too
+def test_plain_post_unchanged():
+    html = '<p>a <b>b</p>\n\n<pre><code class="python">x &lt; 1\n</code></pre>\n'
+    assert process(html) == html
+    html = '<p>run <code>cmd-text-cat</code>, <i>viz-dot</p>\n'
+    html += '<pre><code class="no-viz-dot">x\n</code></pre>\n'
+    assert process(html) == html
+
+
+def test_cmd_text_block():
+    pytest.importorskip('bs4')
+    if not render.ascmini.posix.search_cmd('cat', []):
+        pytest.skip('cat not found')
+    html = '<p>a</p>\n<pre><code class="cmd-text-cat">x &lt; 1\n</code></pre>\n'
+    assert process(html) == '<p>a</p>\n<pre><code>x &lt; 1\n</code></pre>\n'
+
+
+# only the block is rewritten, the html around it is not reserialized
+def test_block_rest_unchanged():
+    if not render.ascmini.posix.search_cmd('cat', []):
+        pytest.skip('cat not found')
+    head = '<p>a <b>b</p>\n<pre><code>x</code>\n</pre>\n<br>\n'
+    tail = '\n<pre class=x><code class="python">"y" &gt; 1</code></pre>\n'
+    html = head + '<pre><code class="cmd-text-cat">z\n</code></pre>' + tail
+    assert process(html, 2) == head + '<pre><code>z\n</code></pre>' + tail